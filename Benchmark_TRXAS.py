@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+Benchmarks the data conditioning and fitting on synthetic files.
+Each stage (loadList, AlignData, bkgSubtract, rebin, getData, fitData) is timed and its peak memory measured
+at several data sizes, the fit is checked against the true parameters and the results are appended as one
+JSON line per run so versions can be compared.
+
+Example:
+    python Benchmark_TRXAS.py --files 1 4 16 --out benchmarks.jsonl
+"""
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import Model_TRXAS_Data as md
+import Model_TRXAS_Fit as mf
+import Model_TRXAS_Synthetic as ms
+
+paramsDict = {'initS1':[.8,0,1],
+              'pAdvance':[.8,0,1],
+              'tauS01':[50,0,None],
+              'tauS12':[90,0,None],
+              'tauS23':[400,0,None],
+              'tau1S30':[50,0,None],
+              'tau2S30':[1300,0,None]}
+
+def measure(fn, *args, **kwargs):
+    """Runs fn once, timing it and tracking the peak of the memory it allocates
+    returns (output, seconds, peak bytes)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    seconds = time.perf_counter()-start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, seconds, peak
+
+def gitVersion():
+    """Commit of the code being benchmarked (None outside a git checkout)"""
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=here).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmarkSize(filesIn, s3Model=mf.sequentialRate, getDataArgs=None):
+    """Benchmarks every stage on one set of files
+    filesIn: synthetic h5 files
+    s3Model: model for the S3-S0 transition the files were made with
+    getDataArgs: keyword arguments for getData
+    returns a dict of {stage: {'seconds', 'peakBytes'}} and the fit parameter errors against the truth"""
+    getDataArgs = getDataArgs or {}
+    stages = {}
+    def record(name, fn, *args, **kwargs):
+        out, seconds, peak = measure(fn, *args, **kwargs)
+        stages[name] = {'seconds': seconds, 'peakBytes': peak}
+        return out
+
+    dataList, scatterList, flashList = record('loadList', md.loadList, filesIn)
+    aligned, _, flashTimes = record('AlignData', md.AlignData, dataList, scatterList, flashList)
+    summed = md.sumData(aligned)
+    record('bkgSubtract', md.bkgSubtract, summed, flashTimes)
+    record('rebin', md.rebin, range(len(summed)), summed, flashTimes[0]+1, flashTimes[0]+6001, 20)
+    del dataList, scatterList, aligned
+    xData, yData, weights, _ = record('getData', md.getData, filesIn, **getDataArgs)
+    fit = record('fitData', mf.fitData, xData, yData, weights, s3Model, paramsDict)
+
+    truth = dict(ms.trueParams)
+    for name in mf.datasetParams:
+        truth[name] *= len(filesIn) #the data are summed over files
+    fitted = dict((name, fit.params[name].value) for name in truth)
+    #the two S3-S0 lifetimes are interchangeable, compare them in order
+    fitted['tau1S30'], fitted['tau2S30'] = sorted([fitted['tau1S30'], fitted['tau2S30']])
+    truth['tau1S30'], truth['tau2S30'] = sorted([truth['tau1S30'], truth['tau2S30']])
+    recovery = dict((name, (fitted[name]-truth[name])/truth[name]) for name in truth)
+    return {'stages': stages, 'nfev': fit.nfev, 'redchi': fit.redchi, 'relativeError': recovery}
+
+def runBenchmarks(fileCounts, outFile=None, workDir=None, traceLength=520000, noise=20., getDataArgs=None):
+    """Makes synthetic files and benchmarks each size
+    fileCounts: numbers of files to benchmark
+    outFile: JSON lines file the run is appended to (default none)
+    workDir: directory for the synthetic files (default a temporary directory)
+    traceLength, noise: passed to the synthetic file generator
+    getDataArgs: keyword arguments for getData
+    returns the run record"""
+    tempDir = None
+    if workDir is None:
+        tempDir = tempfile.TemporaryDirectory()
+        workDir = tempDir.name
+    try:
+        filesIn = ms.makeFileSet(workDir, max(fileCounts), traceLength=traceLength, noise=noise)
+        results = []
+        for count in fileCounts:
+            result = benchmarkSize(filesIn[:count], getDataArgs=getDataArgs)
+            result.update(numFiles=count, traceLength=traceLength)
+            results.append(result)
+    finally:
+        if tempDir is not None:
+            tempDir.cleanup()
+    record = {'version': gitVersion(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'noise': noise,
+              'getDataArgs': getDataArgs or {}, 'results': results}
+    if outFile is not None:
+        with open(outFile, 'a') as f:
+            f.write(json.dumps(record, default=str)+'\n')
+    return record
+
+def printRecord(record):
+    """Prints the stage timings and memory as a table"""
+    for result in record['results']:
+        print('{} files of {} us (nfev {}, reduced chi2 {:.3f})'.format(result['numFiles'], result['traceLength'],
+                                                                        result['nfev'], result['redchi']))
+        for name, stage in result['stages'].items():
+            print('    {:<12} {:10.4f} s {:10.1f} MB'.format(name, stage['seconds'], stage['peakBytes']/1e6))
+        worst = max(result['relativeError'], key=lambda name: abs(result['relativeError'][name]))
+        print('    largest parameter error: {} {:+.1%}'.format(worst, result['relativeError'][worst]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, nargs='+', default=[1, 4], help='numbers of files to benchmark')
+    parser.add_argument('--length', type=int, default=520000, help='points per trace (us)')
+    parser.add_argument('--noise', type=float, default=20., help='fluorescence noise per point')
+    parser.add_argument('--timeBin', type=int, default=1, help='getData timeBin')
+    parser.add_argument('--lazy', action='store_true', help='use lazy windowed loading in getData')
+    parser.add_argument('--workDir', default=None, help='keep the synthetic files in this directory')
+    parser.add_argument('--out', default=None, help='JSON lines file to append the results to')
+    args = parser.parse_args()
+    record = runBenchmarks(args.files, outFile=args.out, workDir=args.workDir, traceLength=args.length,
+                           noise=args.noise, getDataArgs={'timeBin': args.timeBin, 'lazy': args.lazy})
+    printRecord(record)
+
+if __name__ == "__main__":
+    main()
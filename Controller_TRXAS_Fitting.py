@@ -28,40 +28,183 @@ This can be written for each flash as an array [S0-S1,S1-S2,S2-S3,S3-S0]:
 
 Numbers/names of amplidues
 S3 model to use
+
+Run as a batch over a manifest of jobs (JSON), each job naming its files, getData arguments, S3 model and guesses:
+    python Controller_TRXAS_Fitting.py beamtime.json --out results --workers 4
+
+    {"defaults": {"dir": "C:\\Beamtime_Data\\TR_XAS\\Output", "s3Model": "sequentialRate", "cache": "cache",
+                  "getData": {"timeBin": 10}, "fit": {"seedGrid": 21}},
+     "jobs": [{"name": "april2017", "files": ["April_2017_2det.h5", "April_2017_1Det.h5"]},
+              {"name": "july2017", "files": ["July2017_1Det.h5", "July2017_2det.h5"], "s3Model": "simultaneousRates",
+               "params": {"tau1S30": [100, 0, null]}}]}
+
+Jobs override the defaults, "params" entries override paramsDict and relative paths are taken from "dir"
+(or the manifest's directory). Each finished job is checkpointed to <out>/jobs/<name>.json so an interrupted
+batch resumes where it stopped, and <out>/summary.csv tabulates every job.
 """
 
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+from concurrent import futures
+
 import Model_TRXAS_Data as md
 import Model_TRXAS_Fit as mf
-import functools
 
-def main(d, s3_fn):
+#dictionary with lists for [inital guess, min value, max value]
+#Amplitudes are taken based on the data
+paramsDict = {'initS1':[.5,0,1], 
+                'pAdvance':[.8,0,1], 
+                'tauS01':[50,0,None], 
+                'tauS12':[90,0,None], 
+                'tauS23':[400,None,None], 
+                'tau1S30':[50,0,None], 
+                'tau2S30':[1300,0,None]} #example tauS01 is the decay constant for S0 to S1 transition
+
+s3_function = mf.sequentialRate # Model to test for the S3-S0 transition
+
+def loadManifest(manifestFile):
+    """Reads the jobs of a manifest, merging each with the defaults
+    manifestFile: JSON file of {"defaults": {...}, "jobs": [{...}, ...]} (or just the list of jobs)
+    returns the list of complete jobs"""
+    with open(manifestFile) as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {'jobs': manifest}
+    defaults = manifest.get('defaults', {})
+    baseDir = os.path.dirname(os.path.abspath(manifestFile))
+    jobs, names = [], set()
+    for i, jobIn in enumerate(manifest['jobs']):
+        job = dict(defaults, **jobIn)
+        for key in ('getData', 'params', 'fit'):
+            job[key] = dict(defaults.get(key, {}), **jobIn.get(key, {}))
+        job.setdefault('name', 'job{:03d}'.format(i))
+        job.setdefault('s3Model', s3_function.__name__)
+        jobDir = os.path.join(baseDir, job.get('dir', ''))
+        job['files'] = [os.path.join(jobDir, fn) for fn in job['files']]
+        if job.get('cache'):
+            job['cache'] = os.path.join(jobDir, job['cache'])
+        if job['name'] in names:
+            raise Exception('Duplicate job name: {}'.format(job['name']))
+        names.add(job['name'])
+        jobs.append(job)
+    return jobs
+
+def jobKey(job):
+    """Hash of everything that defines a job, a checkpoint is only reused when it matches"""
+    return hashlib.sha1(json.dumps(job, sort_keys=True).encode()).hexdigest()
+
+def runJob(job):
     """
-    Loads in the data, combines it, and fits it to one of a number of kinetic models.
-    Reports on fits and plots.
-    Uses a few hard-coded parameters as the file locations, and initial guesses don't change.
+    Loads in the data, combines it, and fits it to the job's kinetic model.
+    job: complete job from loadManifest
+    returns the result as a dict (JSON ready)
     """
-    inDir = 'C:\\Users\\Pushkar\\Desktop\\Beamtime_Data\\TR_XAS\\Output\\'
-    fileNames = ['April_2017_2det.h5','April_2017_1Det.h5','July2017_1Det.h5','July2017_2det.h5','feb_19_BothDet.h5']
-    filesIn = [inDir+fn for fn in fileNames] 
-
-    #dictionary with lists for [inital guess, min value, max value]
-    #Amplitudes are taken based on the data
-    paramsDict = {'initS1':[.5,0,1], 
-                    'pAdvance':[.8,0,1], 
-                    'tauS01':[50,0,None], 
-                    'tauS12':[90,0,None], 
-                    'tauS23':[400,None,None], 
-                    'tau1S30':[50,0,None], 
-                    'tau2S30':[1300,0,None]} #example tauS01 is the decay constant for S0 to S1 transition
-                    
-    S3Model = functools.partial(s3_fn, **d)
-    xData, yData, weightList, sd = md.getData(filesIn)
-    fit = mf.fitData(xData, yData, weightList, mf.totalModel, s3_fn paramsDict)
-    mf.getAll(fit)
-    #fit.report()
-    fit.plot()
+    start = time.time()
+    s3Model = getattr(mf, job['s3Model'])
+    paramD = dict(paramsDict, **job['params'])
+    if job.get('cache'):
+        xData, yData, weightList, sd = md.getDataCached(job['files'], job['cache'], **job['getData'])
+    else:
+        xData, yData, weightList, sd = md.getData(job['files'], **job['getData'])
+    fit = mf.fitData(xData, yData, weightList, s3Model, paramD, **job['fit'])
+    return {'name': job['name'], 'key': jobKey(job), 'status': 'done', 's3Model': job['s3Model'],
+            'values': dict((name, fit.params[name].value) for name in mf.modelParams),
+            'stderr': dict((name, fit.params[name].stderr) for name in mf.modelParams),
+            'redchi': fit.redchi, 'aic': fit.aic, 'bic': fit.bic, 'nfev': fit.nfev, 'success': fit.success,
+            'Std': float(sd), 'seconds': time.time()-start, 'report': fit.fit_report()}
 
-s3_function = mf.sequentialRate # Model to test for the S3-S0 transition
+def _runSafe(job):
+    """runJob that returns failures as results so one bad job does not stop the batch"""
+    try:
+        return runJob(job)
+    except Exception as err:
+        return {'name': job['name'], 'key': jobKey(job), 'status': 'failed', 's3Model': job['s3Model'],
+                'error': '{}: {}'.format(type(err).__name__, err)}
+
+def _checkpoint(jobDir, result):
+    """Writes a finished job through a temporary file so an interrupt never leaves half a checkpoint"""
+    path = os.path.join(jobDir, result['name']+'.json')
+    with open(path+'.tmp', 'w') as f:
+        json.dump(result, f, indent=1)
+    os.replace(path+'.tmp', path)
+
+def runBatch(jobs, outDir, workers=1, resume=True, callback=None):
+    """
+    Runs the jobs in a pool of at most workers processes, checkpointing each as it finishes
+    jobs: list of jobs from loadManifest
+    outDir: output directory, checkpoints go to outDir/jobs and the table to outDir/summary.csv
+    workers: number of jobs run at once (None for every core)
+    resume: skip jobs with a finished checkpoint of the same job (failed jobs are rerun)
+    callback: called with each result as it finishes
+    returns the list of results in the order of jobs
+    """
+    jobDir = os.path.join(outDir, 'jobs')
+    if not os.path.isdir(jobDir):
+        os.makedirs(jobDir)
+    results, pending = {}, []
+    for job in jobs:
+        path = os.path.join(jobDir, job['name']+'.json')
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                done = json.load(f)
+            if done.get('status') == 'done' and done.get('key') == jobKey(job):
+                results[job['name']] = done
+                continue
+        pending.append(job)
+
+    def finish(result):
+        _checkpoint(jobDir, result)
+        results[result['name']] = result
+        if callback is not None:
+            callback(result)
+    if (workers is None or workers > 1) and len(pending) > 1:
+        with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            for result in futures.as_completed([pool.submit(_runSafe, job) for job in pending]):
+                finish(result.result())
+    else:
+        for job in pending:
+            finish(_runSafe(job))
+
+    results = [results[job['name']] for job in jobs]
+    writeSummary(results, os.path.join(outDir, 'summary.csv'))
+    return results
+
+def writeSummary(results, summaryFile):
+    """Writes one row per job with its fit statistics and parameter values"""
+    columns = ['name', 'status', 's3Model', 'redchi', 'aic', 'bic', 'nfev', 'seconds']
+    with open(summaryFile, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns+mf.modelParams+['error'])
+        for result in results:
+            values = result.get('values', {})
+            writer.writerow([result.get(column, '') for column in columns]
+                            +[values.get(name, '') for name in mf.modelParams]+[result.get('error', '')])
+
+def main(argv=None):
+    """
+    Runs the fits of a manifest from the command line and prints a table of the results.
+    """
+    parser = argparse.ArgumentParser(description='Fits the time resolved x-ray absorption jobs of a manifest')
+    parser.add_argument('manifest', help='JSON manifest of jobs')
+    parser.add_argument('--out', default='results', help='output directory for the checkpoints and summary.csv')
+    parser.add_argument('--workers', type=int, default=1, help='number of jobs run at once (0 for every core)')
+    parser.add_argument('--restart', action='store_true', help='rerun every job instead of resuming')
+    args = parser.parse_args(argv)
+
+    jobs = loadManifest(args.manifest)
+    def report(result):
+        if result['status'] == 'done':
+            print('{:<20} done   redchi {:8.3f} ({:.1f} s)'.format(result['name'], result['redchi'], result['seconds']))
+        else:
+            print('{:<20} failed {}'.format(result['name'], result['error']))
+    results = runBatch(jobs, args.out, workers=args.workers or None, resume=not args.restart, callback=report)
+    failed = [result['name'] for result in results if result['status'] != 'done']
+    print('{} of {} jobs done, summary in {}'.format(len(results)-len(failed), len(results), os.path.join(args.out, 'summary.csv')))
+    return 1 if failed else 0
     
 if __name__ == "__main__":
-    main(d, s3_function)
\ No newline at end of file
+    raise SystemExit(main())
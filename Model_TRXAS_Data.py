@@ -9,14 +9,23 @@ Basically takes the 5 laser flash sequence data and conditions it to have:
 
 Scott Jensen
 """
+import functools
+import hashlib
+import inspect
+import itertools
+import json
+import os
+from concurrent import futures
+
 import numpy as np
 import matplotlib.pyplot as plt  
 import scipy.signal as sci
-from scipy import stats
 
 import h5py
 import scottLib as sl
 
+import Model_TRXAS_Instrument as mi
+
 
 def AlignData(dataList, scatterList, flashList):
     """
@@ -30,31 +39,137 @@ def AlignData(dataList, scatterList, flashList):
     """
     alignedDataList =[]
     alignedScatterList = []
-    alignIdx = np.min(flashList) #lowest flash idx in all lists
-    minListIdx = np.argmin(flashList)//len(flashList[0]) #gets the list of flashTimes that has the min value
-    print(alignIdx)
-    print(minListIdx)
-    for i in range(len(flashList)):
-        offset = np.min(flashList[i])-alignIdx
-        print(offset)
-        print(i)
-        if offset == 0:
-            print('zero Offset')
-            alignedDataList.append(dataList[i])
-            alignedScatterList.append(scatterList[i])
-        else:
-            alignedDataList.append(np.concatenate((dataList[i][offset:],np.zeros(offset))))
-            alignedScatterList.append(np.concatenate((scatterList[i][offset:],np.zeros(offset))))
+    offsets = []
+    with mi.stage('AlignData'):
+        alignIdx = np.min(flashList) #lowest flash idx in all lists
+        minListIdx = np.argmin(flashList)//len(flashList[0]) #gets the list of flashTimes that has the min value
+        for i in range(len(flashList)):
+            offset = np.min(flashList[i])-alignIdx
+            offsets.append(offset)
+            if offset == 0:
+                alignedDataList.append(dataList[i])
+                alignedScatterList.append(scatterList[i])
+            else:
+                alignedDataList.append(np.concatenate((dataList[i][offset:],np.zeros(offset))))
+                alignedScatterList.append(np.concatenate((scatterList[i][offset:],np.zeros(offset))))
+    mi.event('AlignData', alignIdx=alignIdx, minListIdx=minListIdx, offsets=offsets)
     return(alignedDataList, alignedScatterList, flashList[minListIdx])
     
 def sumData(array):
     return(np.array(array).sum(axis = 0))
 
+class AlignedSum(object):
+    """
+    Running sum of traces aligned by their first laser flash, the streaming equivalent of AlignData then sumData
+    Each trace is added in place at its offset so memory stays at one buffer per channel however many files are combined
+    As in AlignData the sums are aligned to the earliest flash seen, leading points are dropped and the end is zero filled
+    dtype: dtype of the running sums (float64 keeps precision when adding float32 traces)
+    """
+    def __init__(self, dtype=np.float64):
+        self.dtype = dtype
+        self.dataSum = None
+        self.scatterSum = None
+        self.flashTimes = None
+        self.numTraces = 0
+
+    def add(self, trace, scatter, flashTimes):
+        """Adds one file's traces
+        trace, scatter: Mn fluorescence and scatter traces (scatter can be None to only sum the fluorescence)
+        flashTimes: times where the laser illumination occured in these traces"""
+        first = np.min(flashTimes)
+        if self.dataSum is None:
+            self.dataSum = np.zeros(len(trace), dtype=self.dtype)
+            self.scatterSum = None if scatter is None else np.zeros(len(scatter), dtype=self.dtype)
+            self.flashTimes = list(flashTimes)
+        elif first < np.min(self.flashTimes):
+            #realign what is already summed to the new earliest flash
+            shift = np.min(self.flashTimes)-first
+            for buf in (self.dataSum, self.scatterSum):
+                if buf is None:
+                    continue
+                buf[:-shift] = buf[shift:]
+                buf[-shift:] = 0
+            self.flashTimes = list(flashTimes)
+        offset = first-np.min(self.flashTimes)
+        n = min(len(trace)-offset, len(self.dataSum))
+        with mi.stage('alignedSum'):
+            self.dataSum[:n] += trace[offset:offset+n]
+            if self.scatterSum is not None:
+                self.scatterSum[:n] += scatter[offset:offset+n]
+        self.numTraces += 1
+        return self
+
+    def result(self):
+        """returns (summed data, summed scatter, flash times) as AlignData and sumData would"""
+        return(self.dataSum, self.scatterSum, self.flashTimes)
+
+def bkgSums(x, y):
+    """
+    Cumulative sums used to find least squares lines for any set of windows in O(1) per window
+    The sums are taken of x less its middle value x0 and y less its first value y0 so the window lines keep their
+    precision for large x (ie absolute us) and large baselines
+    x: x values (1D, shared by every trace)
+    y: data, either a single trace or an array of traces (..., len(x)) ie files x flashes x time
+    returns (x, x0, y0, Sx, Sxx, Sy, Sxy) where each S has a leading zero so S[j]-S[i] sums the points i to j-1
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if np.any(np.diff(x) < 0):
+        order = np.argsort(x, kind='mergesort')
+        x, y = x[order], y[..., order]
+
+    def cumulative(a):
+        #running sums within blocks plus the running sum of the block totals, so the rounding builds up over
+        #about 2*sqrt(len(x)) additions rather than len(x) (windows far down long traces stay accurate)
+        size = a.shape[-1]
+        block = max(int(np.sqrt(size)), 1)
+        numBlocks = -(-size//block)
+        out = np.zeros(a.shape[:-1]+(numBlocks*block+1,))
+        out[..., 1:size+1] = a
+        blocks = out[..., 1:].reshape(a.shape[:-1]+(numBlocks, block))
+        totals = blocks.sum(axis=-1)
+        np.cumsum(blocks, axis=-1, out=blocks)
+        blocks[..., 1:, :] += np.cumsum(totals, axis=-1)[..., :-1, None]
+        return out[..., :size+1]
+    x0 = (x[0]+x[-1])/2. if len(x) else 0.
+    y0 = y[..., 0] if len(x) else np.zeros(y.shape[:-1])
+    xc = x-x0
+    yc = y-np.expand_dims(y0, -1)
+    return(x, x0, y0, cumulative(xc), cumulative(xc*xc), cumulative(yc), cumulative(xc*yc))
+
+def bkgWindowFit(sums, windows):
+    """
+    Least squares line through the points inside the windows using the cumulative sums from bkgSums
+    sums: output of bkgSums
+    windows: non-overlapping sets of x values as endpoints to take the background from
+        For example windows = [[start,stop][start2, stop2]]
+        An array (..., numWindows, 2) gives different windows for each trace (ie one set per flash)
+    returns (slope, intercept) with one value per trace
+    """
+    x, x0, y0, Sx, Sxx, Sy, Sxy = sums
+    windows = np.asarray(windows, dtype=float)
+    lo = np.searchsorted(x, windows.min(axis=-1), side='left')
+    hi = np.searchsorted(x, windows.max(axis=-1), side='right')
+
+    def windowSum(S):
+        if S.ndim == 1:
+            return (S[hi]-S[lo]).sum(axis=-1)
+        shape = S.shape[:-1]+lo.shape[-1:]
+        return (np.take_along_axis(S, np.broadcast_to(hi, shape), axis=-1)
+                - np.take_along_axis(S, np.broadcast_to(lo, shape), axis=-1)).sum(axis=-1)
+    n = (hi-lo).sum(axis=-1)
+    sx, sxx, sy, sxy = windowSum(Sx), windowSum(Sxx), windowSum(Sy), windowSum(Sxy)
+    #about the mean of each window, then the intercept is moved from (x0, y0) back to x = 0
+    mx, my = sx/n, sy/n
+    slope = (sxy-sx*my)/(sxx-sx*mx)
+    intercept = my-slope*mx-slope*x0+y0
+    return(slope, intercept)
+
 def bkgLinear(x, y, windows, returnBkg=False):
 
     """
     Finds and removes the linear background
-    x, y: data as arrays
+    x, y: data as arrays (y can hold several traces as (..., len(x)))
     windows: non-overlapping sets of x values as endpoints to take the background from
         For example windows = [[start,stop][start2, stop2]]
     returnBkg: bool option to return background
@@ -62,14 +177,8 @@ def bkgLinear(x, y, windows, returnBkg=False):
     """
     x=np.asarray(x)
     y=np.asarray(y)
-    xNew = np.array([])
-    yNew = np.array([])
-    for win in windows:
-        idxUse = np.array([i for i, val in enumerate(x) if (val>=np.min(win) and val<=np.max(win))])
-        xNew=np.concatenate((xNew, x[idxUse]))
-        yNew=np.concatenate((yNew, y[idxUse]))
-    slope, intercept, r_value, p_value, std_err = stats.linregress(xNew,yNew)
-    bkg = slope*x +intercept
+    slope, intercept = bkgWindowFit(bkgSums(x, y), windows)
+    bkg = np.multiply.outer(slope, x) + np.expand_dims(intercept, -1)
     yOut = y - bkg
     if returnBkg ==True:
         return(yOut, bkg)
@@ -80,6 +189,7 @@ def bkgSubtract(Data, flashTimes):
     """
     Takes data and subtracts the background after each flash (15000 before 25000 after)
     bkgRange is the range of time before and after the flash that is used for establishing baseline bkg removal
+    All flashes (and all files if Data is files x time with flashTimes files x flashes) are fit at once
     Data: list of data
     flashTimes: times where the laser illumination occured
     """
@@ -88,13 +198,16 @@ def bkgSubtract(Data, flashTimes):
     bkgRange = [[-6000+15000,-1000+15000]]
     bkgRange2 = [[-6000+15000,-1000+15000]]
 
-    bkgSubData = np.array(Data)
-    for i,flashT in enumerate(flashTimes):
-        idxStart, idxEnd = flashT-15000, flashT+25000
-        if i==2:
-            bkgSubData[idxStart:idxEnd] = bkgLinear(np.arange(len(Data[idxStart:idxEnd])), Data[idxStart:idxEnd], bkgRange)
-        else:
-            bkgSubData[idxStart:idxEnd] = bkgLinear(np.arange(len(Data[idxStart:idxEnd])), Data[idxStart:idxEnd], bkgRange2)
+    with mi.stage('bkgSubtract'):
+        bkgSubData = np.array(Data, dtype=float)
+        traces = bkgSubData.reshape((-1, bkgSubData.shape[-1]))
+        flashes = np.asarray(flashTimes).reshape((len(traces), -1))
+        windows = np.array([bkgRange if i==2 else bkgRange2 for i in range(flashes.shape[1])])
+
+        xWin = np.arange(-15000, 25000)
+        idx = flashes[:,:,None] + xWin
+        rows = np.arange(len(traces))[:,None,None]
+        traces[rows, idx] = bkgLinear(xWin+15000, traces[rows, idx], windows)
 
     return(bkgSubData)
 
@@ -106,7 +219,7 @@ def getLaserPos(laserTrace, clockRate=1000000,laserFrequency=10, numFlashes=5):
     numFlashes: number of laser flashes on each sample"""
     #find max peak of laser flashes
     flashMax=[]
-    usPerFlash = clockRate/laserFrequency
+    usPerFlash = clockRate//laserFrequency
     
     #Find the max num of flashes in the range
     for flashNum in range(numFlashes):
@@ -133,47 +246,100 @@ def truncate(xIn, yIn, xStart, xStop):
 def getLinearBkg(xIn, yIn, idxStart, idxStop):
     """Finds the linear background from data based on the range between idxStart and idxStop
     XIn, yIn: the data input
-    idxStart,idxStop: index values into xIn that determine the background range"""
-    xtemp, ytemp = truncate(xIn, yIn, idxStart, idxStop)
-       
-    linFit = np.polyfit(xtemp, ytemp, 1)
-    return (linFit)
-
-def rebin (xIn, yIn, start, stop, step, interp = 11):
-    """Takes in x, y data and rebins the data through linear interpolation
+    idxStart,idxStop: index values into xIn that determine the background range
+    returns [slope, intercept] as np.polyfit does"""
+    slope, intercept = bkgWindowFit(bkgSums(xIn, yIn), [[idxStart, idxStop]])
+    return (np.array([slope, intercept]))
+
+def logBinEdges(start, stop, firstStep, numBins):
+    """Bin edges that grow geometrically so early times keep their resolution
+    start, stop: x values of the first and last edge
+    firstStep: width of the first bin
+    numBins: number of bins wanted (edges are rounded to whole us so fewer may be returned)
+    returns the bin edges as an array"""
+    if firstStep*numBins >= stop-start:
+        return(np.arange(start, stop+firstStep, firstStep, dtype=float).clip(max=stop))
+    #solve firstStep*(r**numBins-1)/(r-1) = stop-start for the growth ratio r by bisection
+    lo, hi = 1., 2.
+    while firstStep*(hi**numBins-1)/(hi-1) < stop-start:
+        hi *= 2
+    for _ in range(100):
+        r = (lo+hi)/2.
+        if firstStep*(r**numBins-1)/(r-1) < stop-start:
+            lo = r
+        else:
+            hi = r
+    widths = firstStep*r**np.arange(numBins)
+    edges = np.round(start+np.concatenate(([0], np.cumsum(widths))))
+    edges[-1] = stop
+    return(np.unique(edges))
+
+def rebinEdges(xIn, yIn, edges):
+    """Rebins data into bins with arbitrary edges by summing the points inside each bin exactly
+    xIn,yIn: arrays of data, xIn ascending (a range is treated as the indices of yIn)
+    edges: ascending bin edges, a point at x falls in bin k if edges[k] <= x < edges[k+1]
+    returns (bin centres, mean in each bin, number of points in each bin, variance of each bin mean)
+    empty bins have a nan mean and variance"""
+    edges = np.asarray(edges, dtype=float)
+    if isinstance(xIn, range) and xIn.step == 1:
+        idx = np.clip(np.ceil(edges-xIn.start), 0, len(xIn)).astype(int)
+    else:
+        idx = np.searchsorted(np.asarray(xIn), edges, side='left')
+    counts = np.diff(idx)
+    full = counts > 0
+    starts = idx[:-1][full]-idx[0]
+    ySeg = np.asarray(yIn[idx[0]:idx[-1]], dtype=float)
+
+    yOut = np.full(len(counts), np.nan)
+    var = np.full(len(counts), np.nan)
+    if len(starts):
+        yOut[full] = np.add.reduceat(ySeg, starts)/counts[full]
+        resid = ySeg-np.repeat(yOut[full], counts[full])
+        var[full] = np.add.reduceat(resid*resid, starts)/counts[full]**2
+    return((edges[:-1]+edges[1:])/2., yOut, counts, var)
+
+def rebin (xIn, yIn, start, stop, step, returnStats=False):
+    """Takes in x, y data and rebins the data by averaging the points in each bin
     xIn,yIn: arrays of data
-    start,stop,step: x start stop values and bin sizes after rebinning
-    interp: number of surrounding values to use during interpolation
+    start,stop,step: x start stop values and bin sizes after rebinning (bins are centred on np.arange(start,stop,step))
+    returnStats: also return the number of points and the variance of the mean in each bin
     returns rebinned data"""
-    if interp%2==0:
-        raise Exception('Interpolation number not odd')
-        
-    halfStep = step/float(interp)*(interp-1)/2.
-    xInterp =(start-halfStep, stop+halfStep, step/interp)
-    yInterp = np.interp(xInterp, xIn, yIn)
-    yOut = np.reshape(yInterp,(-1,interp)).sum(axis=-1)
-    return(np.arange(start,stop,step),yOut)
+    xOut = np.arange(start,stop,step)
+    edges = np.append(xOut, xOut[-1]+step)-step/2.
+    _, yOut, counts, var = rebinEdges(xIn, yIn, edges)
+    if returnStats:
+        return(xOut, yOut, counts, var)
+    return(xOut,yOut)
     
-def getKineticData (xIn, yIn, start, stop, step):
+def getKineticData (xIn, yIn, start, stop, step, edges=None, returnCounts=False):
     """
     This function gets the range of data and offsets the data based on 1ms before the flash
     xIn,yIn: absorption data as arrays
     start, stop, step: microsecond positon in array to extract (also equivalently the index in the array)
+    edges: bin edges in us after the flash (ie from logBinEdges), used in place of step
+    returnCounts: also return the number of points averaged into each value
     """
     
     zeroDataAverage = 1000 #Number of points to average before laser flash to set as zero
     #Rebin, Set the average of previous ~50 us to be the initial zero, then manually set first point as zero
-    if step ==1:
-        xData, yData =xIn[start:stop],np.array(yIn[start:stop])
-        print ('This is yOffset before setting to zero: {}').format(yData[0])
+    if edges is not None:
+        start = start+1 #offset so the us where the sample was hit is not included
+        edges = np.asarray(edges, dtype=float)
+        xData, yData, counts, _ = rebinEdges(xIn, yIn, start+edges[edges <= stop-start])
+    elif step ==1:
+        xData, yData =np.asarray(xIn[start:stop]),np.array(yIn[start:stop])
+        counts = np.ones(len(xData), dtype=int)
+        mi.event('getKineticData', start=start, yOffset=yData[0]) #yOffset before setting to zero
     else:
         start = start+1 #offset so the us where the sample was hit is not included
-        xData, yData = rebin (xIn, yIn, start, stop, step)
+        xData, yData, counts, _ = rebin (xIn, yIn, start, stop, step, returnStats=True)
     xData = xData-start
     yData = yData -np.mean(yIn[start-zeroDataAverage:start-1])
     xData[0] = 0
     yData[0] = 0
     
+    if returnCounts:
+        return(xData,yData,counts)
     return(xData,yData)
     
 def addWeights(xTrace, usWeightRange, var, weightFactor):
@@ -222,37 +388,222 @@ def plotList(listIn):
         plt.show()
     return
 
-def loadData(fileIn):
+def _traceSlice(dset, channel, start=None, stop=None):
+    """Reads one channel of the trace dataset as a hyperslab without loading the other channels
+    dset: h5py dataset holding the traces (channels by time, singleton axes are allowed)
+    channel: 0 Mn fluorescence, 1 scatter, 2 laser
+    start, stop: time indices to read (default the whole trace)"""
+    axes = [i for i, n in enumerate(dset.shape) if n != 1]
+    idx = [0]*len(dset.shape)
+    idx[axes[0]] = channel
+    idx[axes[-1]] = slice(start, stop)
+    out = dset[tuple(idx)]
+    mi.add('bytesRead', out.nbytes)
+    return out
+
+def loadData(fileIn, lazy=False, dtype=None, flashWindow=(15000, 25000)):
     """ Loads data traces (time resolved x-ray absorption spectra)
     fileIn: Input file path (str)
+    lazy: if True only the laser channel is read in full, the fluorescence and scatter channels
+        are read only in the windows around each flash and packed end to end
+    dtype: dtype of the returned traces (ie np.float32 to halve the memory), default keeps the file dtype
+    flashWindow: (us before, us after) each flash that is kept in the lazy mode
     outputs (Mn fluorescence, Scattering, flashTimes)
+    In the lazy mode the flashTimes index into the packed traces (flash i sits at i*sum(flashWindow)+flashWindow[0])
     """
-    with h5py.File(fileIn, 'r') as f:
-        traceData=np.squeeze(np.asarray(f['trace']))
-    flashTimes = getLaserPos(traceData[2,:])
-    #MnFluorescence, Scatter, LaserFlash times (bin numbers)
-    return(traceData[0,:],traceData[1,:], flashTimes)
+    with mi.stage('loadData'), h5py.File(fileIn, 'r') as f:
+        mi.add('filesRead')
+        if not lazy:
+            traceData=np.squeeze(np.asarray(f['trace'], dtype=dtype))
+            mi.add('bytesRead', f['trace'].size*f['trace'].dtype.itemsize)
+            flashTimes = getLaserPos(traceData[2,:])
+            #MnFluorescence, Scatter, LaserFlash times (bin numbers)
+            return(traceData[0,:],traceData[1,:], flashTimes)
 
-def loadList(fileList):
+        dset = f['trace']
+        rawFlashTimes = getLaserPos(_traceSlice(dset, 2))
+        traceLen = dset.shape[[i for i, n in enumerate(dset.shape) if n != 1][-1]]
+        before, after = flashWindow
+        winLen = before+after
+        if dtype is None:
+            dtype = dset.dtype
+        traceD = np.zeros(len(rawFlashTimes)*winLen, dtype=dtype)
+        traceScatter = np.zeros(len(rawFlashTimes)*winLen, dtype=dtype)
+        flashTimes = []
+        for i, flash in enumerate(rawFlashTimes):
+            #clip the window at the ends of the trace, missing points are left as zeros
+            idxStart, idxStop = max(flash-before, 0), min(flash+after, traceLen)
+            outStart = i*winLen + idxStart-(flash-before)
+            outStop = outStart + idxStop-idxStart
+            traceD[outStart:outStop] = _traceSlice(dset, 0, idxStart, idxStop)
+            traceScatter[outStart:outStop] = _traceSlice(dset, 1, idxStart, idxStop)
+            flashTimes.append(i*winLen+before)
+    return(traceD, traceScatter, flashTimes)
+
+def loadList(fileList, lazy=False, dtype=None, workers=1, threads=False):
     """
     Takes the list of file names for h5 files
+    lazy, dtype: passed to loadData
+    workers: number of files loaded at once (1 loads serially, None uses every core)
+    threads: use a thread pool instead of a process pool (less copying, but h5 decompression holds the GIL)
     Outputs the DataTrace and the flashTimestra
     """
+    load = functools.partial(loadData, lazy=lazy, dtype=dtype)
+    with mi.stage('loadList'):
+        if (workers is None or workers > 1) and len(fileList) > 1:
+            Executor = futures.ThreadPoolExecutor if threads else futures.ProcessPoolExecutor
+            with Executor(max_workers=workers) as pool:
+                loaded = list(pool.map(load, fileList))
+        else:
+            loaded = [load(fileIn) for fileIn in fileList]
+
     traceDList, flashTList, traceScatterList = [],[],[]
-    for fileIn in fileList:
-        traceD, traceScatter, flashT = loadData(fileIn)
+    for traceD, traceScatter, flashT in loaded:
         traceDList.append(traceD)
         traceScatterList.append(traceScatter)
         flashTList.append(flashT)
     return(traceDList,traceScatterList,flashTList)
 
+def loadAligned(fileList, lazy=False, dtype=None, workers=1, threads=False, accumulate=np.float64, accumulator=None):
+    """
+    Loads the files and sums them aligned by flash, one file at a time so the raw traces are never all held at once
+    lazy, dtype: passed to loadData
+    workers, threads: as for loadList, at most workers files are held while waiting to be summed
+    accumulate: dtype of the running sums
+    accumulator: AlignedSum to add the files to (ie one kept from earlier files), a new one by default
+    returns (summed data, summed scatter, flash times)
+    """
+    load = functools.partial(loadData, lazy=lazy, dtype=dtype)
+    if accumulator is None:
+        accumulator = AlignedSum(dtype=accumulate)
+    with mi.stage('loadAligned'):
+        if (workers is None or workers > 1) and len(fileList) > 1:
+            Executor = futures.ThreadPoolExecutor if threads else futures.ProcessPoolExecutor
+            maxPending = workers or os.cpu_count() or 1
+            with Executor(max_workers=workers) as pool:
+                pending = set()
+                for fileIn in fileList:
+                    pending.add(pool.submit(load, fileIn))
+                    if len(pending) >= maxPending:
+                        done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                        for loaded in done:
+                            accumulator.add(*loaded.result())
+                for loaded in futures.as_completed(pending):
+                    accumulator.add(*loaded.result())
+        else:
+            for fileIn in fileList:
+                accumulator.add(*load(fileIn))
+    return accumulator.result()
+
+def loadLaser(fileIn, halfWidth=32):
+    """Reads only the laser channel and cuts out the pulse around each flash (for flashOffsets)
+    fileIn: Input file path (str)
+    halfWidth: points kept on each side of the laser maximum
+    returns (flashTimes from getLaserPos, pulses as flashes x 2*halfWidth+1)"""
+    with mi.stage('loadLaser'), h5py.File(fileIn, 'r') as f:
+        laser = _traceSlice(f['trace'], 2)
+    flashTimes = getLaserPos(laser)
+    idx = np.clip(np.asarray(flashTimes)[:,None]+np.arange(-halfWidth, halfWidth+1), 0, len(laser)-1)
+    return(flashTimes, laser[idx].astype(float))
+
+def flashOffsets(pulses, reference=None):
+    """
+    Sub-sample offsets of laser pulses from a reference pulse by FFT cross-correlation, every file and flash at once
+    The correlation peak is refined by fitting a parabola through it and its two neighbours
+    pulses: laser pulses centred on the integer flash times (..., width), ie files x flashes x width from loadLaser
+    reference: pulse shape to align to (default the mean pulse)
+    returns offsets (...) in us to add to the integer flash times (positive when the pulse is late)
+    """
+    pulses = np.asarray(pulses, dtype=float)
+    width = pulses.shape[-1]
+    pulses = pulses-pulses.mean(axis=-1, keepdims=True)
+    if reference is None:
+        reference = pulses.reshape((-1, width)).mean(axis=0)
+    reference = np.asarray(reference, dtype=float)
+    reference = reference-reference.mean()
+    n = 2*width #zero padded so the correlation does not wrap around
+    corr = np.fft.irfft(np.fft.rfft(pulses, n)*np.conj(np.fft.rfft(reference, n)), n)
+    corr = np.fft.fftshift(corr, axes=-1)[..., 1:] #lags -width+1 to width-1
+    peak = np.clip(np.argmax(corr, axis=-1), 1, n-3)
+    y0, y1, y2 = [np.take_along_axis(corr, (peak+k)[...,None], axis=-1)[...,0] for k in (-1, 0, 1)]
+    curvature = y0-2*y1+y2
+    delta = np.where(curvature < 0, 0.5*(y0-y2)/np.where(curvature < 0, curvature, 1), 0.)
+    return peak+delta-(width-1)
+
+def loadFlashWindows(fileIn, flashTimes, dtype=None, flashWindow=(15000, 25000)):
+    """Reads the windows around each flash resampled (linear interpolation) so every flash falls exactly on a point
+    fileIn: Input file path (str)
+    flashTimes: flash times in us, fractional (ie integer flash times plus flashOffsets)
+    dtype, flashWindow: as for loadData in the lazy mode
+    returns (Mn fluorescence, Scattering, flashTimes) packed as loadData does in the lazy mode"""
+    before, after = flashWindow
+    winLen = before+after
+    with mi.stage('loadData'), h5py.File(fileIn, 'r') as f:
+        mi.add('filesRead')
+        dset = f['trace']
+        traceLen = dset.shape[[i for i, n in enumerate(dset.shape) if n != 1][-1]]
+        out = np.zeros((2, len(flashTimes)*winLen), dtype=dset.dtype if dtype is None else dtype)
+        for i, flash in enumerate(flashTimes):
+            first = int(np.floor(flash))
+            frac = flash-first
+            #one extra point so each output point sits between two read points, missing points are left as zeros
+            idxStart, idxStop = max(first-before, 0), min(first+after+1, traceLen)
+            for channel in (0, 1):
+                raw = np.zeros(winLen+1)
+                raw[idxStart-(first-before):idxStop-(first-before)] = _traceSlice(dset, channel, idxStart, idxStop)
+                out[channel, i*winLen:(i+1)*winLen] = (1-frac)*raw[:-1]+frac*raw[1:]
+    return(out[0], out[1], [i*winLen+before for i in range(len(flashTimes))])
+
+def loadAlignedFlashes(fileList, dtype=None, flashWindow=(15000, 25000), halfWidth=32, workers=1, threads=False,
+                       accumulate=np.float64, accumulator=None):
+    """
+    Loads and sums the files with every flash of every file aligned to a fraction of a us
+    The laser channels of all files are read first and their flash offsets found together by flashOffsets,
+    then each file's flash windows are read shifted by their own offsets and summed one file at a time
+    dtype, flashWindow: as for loadData in the lazy mode
+    halfWidth: half width of the laser pulse used for the cross-correlation (see loadLaser)
+    workers, threads, accumulate, accumulator: as for loadAligned
+    returns (summed data, summed scatter, flash times) packed as loadData does in the lazy mode
+    """
+    load = functools.partial(loadLaser, halfWidth=halfWidth)
+    if (workers is None or workers > 1) and len(fileList) > 1:
+        Executor = futures.ThreadPoolExecutor if threads else futures.ProcessPoolExecutor
+        with Executor(max_workers=workers) as pool:
+            lasers = list(pool.map(load, fileList))
+    else:
+        lasers = [load(fileIn) for fileIn in fileList]
+    with mi.stage('flashOffsets'):
+        offsets = flashOffsets(np.array([pulses for _, pulses in lasers]))
+    flashTimes = np.array([times for times, _ in lasers])+offsets
+    mi.event('loadAlignedFlashes', flashTimes=flashTimes)
+
+    if accumulator is None:
+        accumulator = AlignedSum(dtype=accumulate)
+    load = functools.partial(loadFlashWindows, dtype=dtype, flashWindow=flashWindow)
+    with mi.stage('loadAligned'):
+        if (workers is None or workers > 1) and len(fileList) > 1:
+            with Executor(max_workers=workers) as pool:
+                for loaded in pool.map(load, fileList, flashTimes):
+                    accumulator.add(*loaded)
+        else:
+            for fileIn, times in zip(fileList, flashTimes):
+                accumulator.add(*load(fileIn, times))
+    return accumulator.result()
+
 def getData(filesIn,
             timeBin = 1, 
             kineticTime=[3000, 3000, 6000, 3000, 3000],
             finalBkg = [5000,5000,5000,5000,5000],
             usWeightRange = [500, 300, 1500, 300, 500], 
             smoothNum=0,
-            weightFactor=1 ):
+            weightFactor=1,
+            binning='linear',
+            numBins=300,
+            lazy=False,
+            dtype=None,
+            workers=1,
+            alignment='first',
+            returnNoise=False):
     """Gets the original time sequence, and laser sequence
     Takes the data around the laser flash to isolate the kinetic changes
     removes the background based baseline data after and before laser flash
@@ -264,45 +615,283 @@ def getData(filesIn,
     useWeightRange: the range to weight data
     smoothNum: window length for a linear interpolation/smoothing (default 0 meaning no filter)
     weightFactor: how much to weight the data by at the begining of the transition (default 1 meaning no weighting)
-    returns data, weights, and standard deviation of the baseline data
+    binning: 'linear' bins of timeBin, 'log' bins growing geometrically from timeBin (numBins per flash)
+        For 'log' the weights use the single point variance over the number of points in each bin
+    numBins: number of bins per flash for 'log' binning
+    lazy: only read the windows around each flash from the files (see loadData)
+    dtype: dtype to store the loaded traces as (ie np.float32)
+    workers: number of files loaded in parallel (None uses every core)
+    alignment: 'first' shifts each file by the whole us offset of its first flash,
+        'flash' aligns every flash of every file to a fraction of a us (see loadAlignedFlashes, always lazy)
+    returnNoise: also return the noise standard deviation of every bin (without weightFactor, for iterBootstrap)
+    returns data, weights, and standard deviation of the baseline data (and the bin noise when returnNoise)
     """
-    inputDataList, scatterList, flashTimesList = loadList(filesIn) #load Data
-    
-    alignedData, scatterTrace, flashTimes = AlignData(inputDataList, scatterList, flashTimesList) #align Data
-    #alignedData = [alignedData[i]/scatterTrace[i] for i in range(len(alignedData))]
-    inputData=sumData(alignedData) # combine data sets
+    #load, align by flash and combine the data sets one file at a time
+    with mi.stage('getData'):
+        inputData, scatterTrace, flashTimes = loadFiles(filesIn, lazy=lazy, dtype=dtype, workers=workers, alignment=alignment)
+        return conditionData(inputData, flashTimes, timeBin=timeBin, kineticTime=kineticTime, finalBkg=finalBkg,
+                             usWeightRange=usWeightRange, smoothNum=smoothNum, weightFactor=weightFactor,
+                             binning=binning, numBins=numBins, returnNoise=returnNoise)
+
+def loadFiles(filesIn, lazy=False, dtype=None, workers=1, alignment='first'):
+    """Loads, aligns and sums the files with the alignment chosen in getData
+    returns (summed data, summed scatter, flash times)"""
+    if alignment == 'first':
+        return loadAligned(filesIn, lazy=lazy, dtype=dtype, workers=workers)
+    elif alignment == 'flash':
+        return loadAlignedFlashes(filesIn, dtype=dtype, workers=workers)
+    raise Exception('Unknown alignment: {}'.format(alignment))
+
+def extractFlash(inputData, flash, timeBin, kineticTime, finalBkg, binning='linear', numBins=300):
+    """Cuts out and rebins the kinetics after one flash through the end of its background window (the extraction stage)
+    inputData: aligned and summed data
+    flash: time of the laser flash
+    timeBin, kineticTime, finalBkg, binning, numBins: see getData (kineticTime and finalBkg for this flash only)
+    returns (x, y, number of points in each bin)"""
+    stop = flash+kineticTime+finalBkg
+    if binning == 'linear':
+        edges = None
+    elif binning == 'log':
+        edges = logBinEdges(0, stop-flash-1, timeBin, numBins)
+    else:
+        raise Exception('Unknown binning: {}'.format(binning))
+    return getKineticData (range(len(inputData)), inputData, flash, stop, timeBin, edges=edges, returnCounts=True)
+
+def removeFlashBkg(xTraceBkg, yTraceBkg, kineticTime, finalBkg):
+    """Removes the background slope fit from kineticTime to kineticTime+finalBkg and drops the background window (the background stage)
+    xTraceBkg, yTraceBkg: output of extractFlash
+    kineticTime, finalBkg: for this flash
+    returns (x, y) up to kineticTime"""
+    keep = xTraceBkg<=kineticTime
+    xTrace, yTrace = xTraceBkg[keep], yTraceBkg[keep]
+    BkgSlope, BkgConst = getLinearBkg(xTraceBkg, yTraceBkg, kineticTime, kineticTime+finalBkg)
+    return(xTrace, yTrace - BkgSlope*xTrace) #Note that we want yBkg[0] to remain at zero so the constant offset is not used
 
-    Std = np.std(inputData[flashTimes[1]-5000:flashTimes[1]])
-    print('Std: {}'.format(Std))
+def conditionData(inputData,
+                  flashTimes,
+                  timeBin = 1, 
+                  kineticTime=[3000, 3000, 6000, 3000, 3000],
+                  finalBkg = [5000,5000,5000,5000,5000],
+                  usWeightRange = [500, 300, 1500, 300, 500], 
+                  smoothNum=0,
+                  weightFactor=1,
+                  binning='linear',
+                  numBins=300,
+                  returnNoise=False,
+                  memo=None):
+    """Takes the summed and aligned data and conditions the kinetics after each flash for fitting (the second half of getData)
+    Each flash goes through the extraction (rebin), background, smooth and weights stages
+    inputData: aligned and summed data
+    flashTimes: times where the laser illumination occured
+    timeBin, kineticTime, finalBkg, usWeightRange, smoothNum, weightFactor, binning, numBins, returnNoise: see getData
+    memo: dict of stage results for this inputData, stages whose inputs are unchanged since an earlier call are reused
+        (only pass the same dict with the same inputData and flashTimes, see DataPipeline)
+    returns data, weights, and standard deviation of the baseline data (and the bin noise when returnNoise)
+    """
+    memo = {} if memo is None else memo
+    def stage(key, fn, *args):
+        if key in memo:
+            mi.add('memoHits')
+        else:
+            with mi.stage(key[0]):
+                memo[key] = fn(*args)
+        return memo[key]
+
+    Std = stage(('std',), lambda: np.std(inputData[flashTimes[1]-5000:flashTimes[1]]))
+    mi.event('conditionData', Std=Std)
     
-    kineticList, xList, weights = [],[], []
+    kineticList, xList, weights, noise = [],[], [], []
+    oldX = range(len(inputData))
+    pointVar = None
+    if binning != 'linear':
+        pointVar = stage(('var', 1), getVar, oldX, inputData, flashTimes[0]-1000, flashTimes[0], 1)
+    else:
+        var = stage(('var', timeBin), getVar, oldX, inputData, flashTimes[0]-1000, flashTimes[0], timeBin)
 
     for i, flash in enumerate(flashTimes):
     
-        oldX = range(len(inputData))
-    
         # Here I get data that is offset to zero, rebinned and has a range for bkg
-        xTraceBkg, yTraceBkg = getKineticData (oldX, inputData, flash, flash+kineticTime[i]+finalBkg[i], timeBin)
-        
-        #remove Data before the laser flash
-        xTrace = xTraceBkg[xTraceBkg<=kineticTime[i]]
-        yTrace = yTraceBkg[xTraceBkg<=kineticTime[i]]
+        extractKey = ('rebin', i, timeBin, kineticTime[i]+finalBkg[i], binning, numBins if binning != 'linear' else None)
+        xTraceBkg, yTraceBkg, countsBkg = stage(extractKey, extractFlash, inputData, flash, timeBin, kineticTime[i],
+                                                finalBkg[i], binning, numBins)
         
-        #BkgRemoval
-        BkgSlope, BkgConst = getLinearBkg(xTraceBkg, yTraceBkg, kineticTime[i],kineticTime[i]+finalBkg[i])
-        yNoBkg = yTrace - BkgSlope*xTrace #Note that we want yBkg[0] to remain at zero so the constant offset is not used
+        #remove Data before the laser flash and the background
+        bkgKey = ('background', extractKey, kineticTime[i], finalBkg[i])
+        xTrace, yTrace = stage(bkgKey, removeFlashBkg, xTraceBkg, yTraceBkg, kineticTime[i], finalBkg[i])
     
         #smooth if desired
         if smoothNum != 0:
-            yTrace = sci.savgol_filter(yNoBkg, smoothNum, 1)
+            yTrace = stage(('smooth', bkgKey, smoothNum), sci.savgol_filter, yTrace, smoothNum, 1)
     
         #Making the weights with the variance
-        if i == 0:
-            var = getVar(oldX, inputData, flash-1000, flash, timeBin)
-        weightList = addWeights(xTrace, usWeightRange[i], var, weightFactor)
+        if binning != 'linear':
+            var = pointVar/countsBkg[xTraceBkg<=kineticTime[i]]
+        weightList = stage(('weights', bkgKey, usWeightRange[i], weightFactor),
+                           addWeights, xTrace, usWeightRange[i], var, weightFactor)
         #weightList = [var**0.5]*len(xTrace)
     
         weights.append(weightList)
         kineticList.append(yTrace)
         xList.append(xTrace)
+        noise.append(np.sqrt(var)*np.ones(len(xTrace)))
+    if returnNoise:
+        return(xList, kineticList, weights, Std, noise)
+    return(xList, kineticList, weights, Std)
+
+class DataPipeline(object):
+    """
+    getData split into memoized stages for parameter sweeps
+    The files are loaded, aligned and summed once (per lazy/dtype), then the per flash extraction, background,
+    smoothing and weights are kept keyed on their inputs so changing a downstream argument only re-runs the stages it invalidates
+    filesIn, lazy, dtype, workers, alignment: as for getData
+    """
+    def __init__(self, filesIn, lazy=False, dtype=None, workers=1, alignment='first'):
+        self.filesIn = list(filesIn)
+        self.lazy = lazy
+        self.dtype = dtype
+        self.workers = workers
+        self.alignment = alignment
+        self._summed = None
+        self.memo = {}
+
+    def summed(self):
+        """returns (summed data, summed scatter, flash times) loading the files the first time"""
+        if self._summed is None:
+            self._summed = loadFiles(self.filesIn, lazy=self.lazy, dtype=self.dtype, workers=self.workers,
+                                     alignment=self.alignment)
+        return self._summed
+
+    def run(self, **conditionArgs):
+        """Conditions the summed data, reusing every stage whose inputs are unchanged
+        conditionArgs: timeBin, kineticTime, finalBkg, usWeightRange, smoothNum, weightFactor, binning, numBins, returnNoise
+            (see getData)
+        returns the same (xList, kineticList, weights, Std) as getData"""
+        inputData, _, flashTimes = self.summed()
+        return conditionData(inputData, flashTimes, memo=self.memo, **conditionArgs)
+
+    def sweep(self, argSets, workers=1):
+        """Runs the conditioning for many sets of arguments, sharing the stages they have in common
+        argSets: list of dicts of conditionArgs, or a dict of {argument: list of values} run as a full grid
+        workers: number of argument sets run at once in threads (None for every core)
+        returns a list of (conditionArgs, (xList, kineticList, weights, Std))"""
+        if isinstance(argSets, dict):
+            names = sorted(argSets)
+            argSets = [dict(zip(names, values)) for values in itertools.product(*[argSets[name] for name in names])]
+        self.summed()
+        if workers == 1 or len(argSets) < 2:
+            return [(args, self.run(**args)) for args in argSets]
+        with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda args: self.run(**args), argSets))
+        return list(zip(argSets, results))
+
+    def clear(self):
+        """Forgets the conditioning stages (the summed data are kept)"""
+        self.memo = {}
+
+def _fileHash(fileIn, hashIndex):
+    """sha1 of the file contents, reused from hashIndex while the file size and modification time are unchanged
+    fileIn: file path
+    hashIndex: dict of {path: [size, mtime, hash]} that is updated in place"""
+    path = os.path.abspath(fileIn)
+    stat = os.stat(path)
+    known = hashIndex.get(path)
+    if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime:
+        return known[2]
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    hashIndex[path] = [stat.st_size, stat.st_mtime, sha.hexdigest()]
+    return sha.hexdigest()
+
+def _writeAtomic(path, write):
+    """Writes through a temporary file so a crash never leaves a half written cache entry
+    path: final file path
+    write: function taking an open binary file"""
+    tmp = path+'.tmp{}'.format(os.getpid())
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+def evictCache(cacheDir, maxCacheBytes):
+    """Deletes the least recently used getData cache entries until the cache is below maxCacheBytes
+    cacheDir: cache directory used by getDataCached
+    maxCacheBytes: size limit in bytes"""
+    entries = []
+    for name in os.listdir(cacheDir):
+        if name.endswith('.npy'):
+            path = os.path.join(cacheDir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(entry[1] for entry in entries)
+    for _, size, path in sorted(entries):
+        if total <= maxCacheBytes:
+            break
+        for oldFile in (path, path[:-4]+'.json'):
+            if os.path.exists(oldFile):
+                os.remove(oldFile)
+        total -= size
+
+#version of the getDataCached entries, part of every key
+#bump it whenever the output of getData changes for the same arguments so older entries are no longer served
+#2: the background slope is removed without smoothing as well
+#3: the entries also hold the bin noise
+cacheVersion = 3
+
+def getDataCached(filesIn, cacheDir, maxCacheBytes=None, **getDataArgs):
+    """getData with the result stored on disk so repeat runs skip loading and conditioning the raw files
+    The key combines cacheVersion, the content hash of every input file and every getData argument (except workers)
+    with the defaults filled in, so leaving an argument out or passing its default give the same entry
+    Entries are one packed .npy (x, kinetics, weights and the bin noise by time) read back memory mapped plus a small .json
+    filesIn: file path to files
+    cacheDir: directory for the cache (created if missing)
+    maxCacheBytes: size limit for the cache, least recently used entries are deleted past it (default no limit)
+    getDataArgs: keyword arguments for getData (timeBin, kineticTime, finalBkg, ...)
+    returns the same (xList, kineticList, weights, Std) as getData (and the bin noise with returnNoise=True)
+    """
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir, exist_ok=True) #batch jobs can create it at the same time
+    hashPath = os.path.join(cacheDir, 'fileHashes.json')
+    hashIndex = {}
+    if os.path.exists(hashPath):
+        with open(hashPath) as f:
+            hashIndex = json.load(f)
+    fileHashes = [_fileHash(fileIn, hashIndex) for fileIn in filesIn]
+    _writeAtomic(hashPath, lambda f: f.write(json.dumps(hashIndex).encode()))
+
+    bound = inspect.signature(getData).bind(filesIn, **getDataArgs)
+    bound.apply_defaults()
+    keyArgs = dict((arg, value) for arg, value in bound.arguments.items() if arg not in ('filesIn', 'workers', 'returnNoise'))
+    returnNoise = bound.arguments['returnNoise']
+    if keyArgs['dtype'] is not None:
+        keyArgs['dtype'] = np.dtype(keyArgs['dtype']).str
+    keyText = json.dumps([cacheVersion, fileHashes, sorted(keyArgs.items())], default=str)
+    key = hashlib.sha1(keyText.encode()).hexdigest()
+    dataPath = os.path.join(cacheDir, key+'.npy')
+    metaPath = os.path.join(cacheDir, key+'.json')
+
+    if os.path.exists(dataPath) and os.path.exists(metaPath):
+        with open(metaPath) as f:
+            meta = json.load(f)
+        packed = np.load(dataPath, mmap_mode='r')
+        os.utime(dataPath, None) #marks the entry as recently used
+        splits = np.cumsum(meta['lengths'])[:-1]
+        xList, kineticList, weights, noise = [np.split(row, splits) for row in packed]
+        mi.add('cacheHits')
+        if returnNoise:
+            return(xList, kineticList, weights, meta['Std'], noise)
+        return(xList, kineticList, weights, meta['Std'])
+
+    mi.add('cacheMisses')
+    getDataArgs['returnNoise'] = True
+    xList, kineticList, weights, Std, noise = getData(filesIn, **getDataArgs)
+    packed = np.array([np.concatenate(xList), np.concatenate(kineticList), np.concatenate(weights),
+                       np.concatenate(noise)], dtype=float)
+    _writeAtomic(dataPath, lambda f: np.save(f, packed))
+    meta = {'lengths': [len(x) for x in xList], 'Std': float(Std), 'files': list(filesIn), 'key': keyText}
+    _writeAtomic(metaPath, lambda f: f.write(json.dumps(meta).encode()))
+    if maxCacheBytes is not None:
+        evictCache(cacheDir, maxCacheBytes)
+    if returnNoise:
+        return(xList, kineticList, weights, Std, noise)
     return(xList, kineticList, weights, Std)
@@ -2,8 +2,17 @@
 """
 Library of functions for fitting the series of time resolved x-ray absorption of photosystem II.
 """
+import functools
+import itertools
+import os
+import warnings
+from concurrent import futures
+
 import numpy as np
 import lmfit
+from scipy.special import comb
+
+import Model_TRXAS_Instrument as mi
 
 def singleRate(t, amp1, tau1, amp2=None, tau2=None):
     """This model treats the absortion changes as a simple chemical process:
@@ -15,6 +24,28 @@ def singleRate(t, amp1, tau1, amp2=None, tau2=None):
     value = amp1*(1-np.exp(-t/tau1))
     return value
 
+def _sequentialTerms(t, k1, k2):
+    """Terms shared by the sequential models written so they stay finite when k1 == k2
+    returns e1 = exp(-k1*t), e2 = exp(-k2*t) and h = (e1-e2)/(k2-k1) (which is t*e1 at k1 == k2)"""
+    t = np.asarray(t, dtype=float)
+    e1 = np.exp(-k1*t)
+    e2 = np.exp(-k2*t)
+    x = (k2-k1)*t
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h = np.where(np.abs(x) < 1e-3, t*e1*(1-x/2.+x*x/6.), (e1-e2)/(k2-k1))
+    return e1, e2, h
+
+def _sequentialTermsGrad(t, k1, k2, e1, e2, h):
+    """Derivatives of h from _sequentialTerms with respect to k1 and k2"""
+    t = np.asarray(t, dtype=float)
+    x = (k2-k1)*t
+    small = np.abs(x) < 1e-3
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dgdD = t*t*(-0.5+x/3.-x*x/8.) #series of d/dD (1-exp(-D*t))/D for D*t near zero
+        dhdk1 = np.where(small, -t*h-e1*dgdD, (h-t*e1)/(k2-k1))
+        dhdk2 = np.where(small, e1*dgdD, (t*e2-h)/(k2-k1))
+    return dhdk1, dhdk2
+
 def sequentialRate(t, amp1, amp2, tau1, tau2):
     """This model treats the absortion changes as a simple chemical process:
     population A goes changes into B then B changes in to C
@@ -26,7 +57,8 @@ def sequentialRate(t, amp1, amp2, tau1, tau2):
     """
     k1=tau1**(-1)
     k2=tau2**(-1)
-    value = amp2*(1+(k1*np.exp(-t*k2)-k2*np.exp(-t*k1))/(k2-k1))+amp1*(k1/(k2-k1)*(np.exp(-k1*t)-np.exp(-k2*t)))
+    e1, e2, h = _sequentialTerms(t, k1, k2)
+    value = amp2*(1-e1-k1*h)+amp1*k1*h
     return value
      
 def simultaneousRates(t, amp1, amp2, tau1,tau2):
@@ -54,27 +86,90 @@ def sequentialExp (t, amp1, tau1, tau2, amp2=None):
     """
     k1=tau1**(-1)
     k2=tau2**(-1)
-    value = amp1*(1+(k1*np.exp(-t*k2)-k2*np.exp(-t*k1))/(k2-k1))
+    e1, e2, h = _sequentialTerms(t, k1, k2)
+    value = amp1*(1-e1-k1*h)
     return value
 
     
+def singleRateGrad(t, amp1, tau1, amp2=None, tau2=None):
+    """Partial derivatives of singleRate
+    returns an array (4, len(t)) of the derivatives with respect to amp1, amp2, tau1, tau2"""
+    t = np.asarray(t, dtype=float)
+    grad = np.zeros((4, len(t)))
+    e1 = np.exp(-t/tau1)
+    grad[0] = 1-e1
+    grad[2] = -amp1*t/tau1**2*e1
+    return grad
+
+def sequentialRateGrad(t, amp1, amp2, tau1, tau2):
+    """Partial derivatives of sequentialRate
+    returns an array (4, len(t)) of the derivatives with respect to amp1, amp2, tau1, tau2"""
+    k1=tau1**(-1)
+    k2=tau2**(-1)
+    e1, e2, h = _sequentialTerms(t, k1, k2)
+    dhdk1, dhdk2 = _sequentialTermsGrad(t, k1, k2, e1, e2, h)
+    grad = np.zeros((4, len(h)))
+    grad[0] = k1*h
+    grad[1] = 1-e1-k1*h
+    #chain rule through k = 1/tau
+    grad[2] = -k1**2*(amp1*(h+k1*dhdk1)+amp2*(t*e1-h-k1*dhdk1))
+    grad[3] = -k2**2*(amp1*k1*dhdk2-amp2*k1*dhdk2)
+    return grad
+
+def simultaneousRatesGrad(t, amp1, amp2, tau1, tau2):
+    """Partial derivatives of simultaneousRates
+    returns an array (4, len(t)) of the derivatives with respect to amp1, amp2, tau1, tau2"""
+    t = np.asarray(t, dtype=float)
+    grad = np.zeros((4, len(t)))
+    e1 = np.exp(-t/tau1)
+    e2 = np.exp(-t/tau2)
+    grad[0] = 1-e1
+    grad[1] = 1-e2
+    grad[2] = -amp1*t/tau1**2*e1
+    grad[3] = -amp2*t/tau2**2*e2
+    return grad
+
+def sequentialExpGrad(t, amp1, tau1, tau2, amp2=None):
+    """Partial derivatives of sequentialExp
+    returns an array (4, len(t)) of the derivatives with respect to amp1, amp2, tau1, tau2"""
+    k1=tau1**(-1)
+    k2=tau2**(-1)
+    e1, e2, h = _sequentialTerms(t, k1, k2)
+    dhdk1, dhdk2 = _sequentialTermsGrad(t, k1, k2, e1, e2, h)
+    grad = np.zeros((4, len(h)))
+    grad[0] = 1-e1-k1*h
+    grad[2] = -k1**2*amp1*(t*e1-h-k1*dhdk1)
+    grad[3] = k2**2*amp1*k1*dhdk2
+    return grad
+
+#S3-S0 models with analytic derivatives, used by fitData to pass a Jacobian to the optimizer
+modelGradients = {singleRate: singleRateGrad,
+                  sequentialRate: sequentialRateGrad,
+                  simultaneousRates: simultaneousRatesGrad,
+                  sequentialExp: sequentialExpGrad}
+
 def sStatePopulation(initS1, pAdvance, numFlashes):
     """
-    Takes floats for all variables except flash num which is an int, outputs numpy array
+    Takes floats (or arrays of floats that broadcast together) for all variables except flash num which is an int, outputs numpy array
     Finds the population of the S-states based on the inital conditions and advancement probability
     Technically the final population is unecessary but I left it in for reference/validation
+    Each flash applies the Kok cycle matrix M = (1-p)I + pP (P shifts S0->S1->S2->S3->S0)
+    Since I and P commute M**f is binomial: after f flashes a center has advanced j times with probability comb(f,j) p**j (1-p)**(f-j)
+    returns an array (..., numFlashes+1, 4) for the grid of initS1, pAdvance
     """
-    if pAdvance>1 or initS1<0 or initS1>1:
+    initS1 = np.asarray(initS1, dtype=float)
+    pAdvance = np.asarray(pAdvance, dtype=float)
+    if np.any(pAdvance>1) or np.any(initS1<0) or np.any(initS1>1):
         raise Exception('PSII Advancement and initial populations cannot be over 1')
-        
-    sStatePop = np.zeros((numFlashes+1,4))
-    
-    sStatePop[0,0]=1-initS1 #Initial population
-    sStatePop[0,1]=initS1 #Initial population
-    
-    for f in range(1,numFlashes+1):
-        for s in range(0,4):
-            sStatePop[f,s] = sStatePop[f-1,s-1]*pAdvance+sStatePop[f-1,s]*(1-pAdvance)
+
+    f = np.arange(numFlashes+1)[:,None]
+    j = np.arange(numFlashes+1)[None,:]
+    p = pAdvance[...,None,None]
+    advanced = comb(f, j)*p**j*(1-p)**np.clip(f-j, 0, None) #[..., flash, times advanced]
+    cycle = (np.arange(numFlashes+1)[:,None] % 4) == np.arange(4) #advancing j times from S0 ends in S(j%4)
+    fromS0 = advanced.dot(cycle)
+    init = initS1[...,None,None]
+    sStatePop = (1-init)*fromS0 + init*np.roll(fromS0, 1, axis=-1) #Initial population split between S0 and S1
     return (sStatePop)
     
 def sStateAdvancement(sStatePop, pAdvance):
@@ -83,26 +178,54 @@ def sStateAdvancement(sStatePop, pAdvance):
     sStatePop: numpy array of the population in each state 
     pAdvance: the percentage of advancement as a fraction 
     """
-    return(sStatePop*pAdvance)
+    return(sStatePop*np.asarray(pAdvance)[...,None,None])
+
+@functools.lru_cache(maxsize=1024)
+def _cachedAdvance(initS1, pAdvance, numFlashes):
+    """getAdvance for scalars, cached since the optimizer revisits the same values (read only output)"""
+    advM = sStateAdvancement(sStatePopulation(initS1, pAdvance, numFlashes),pAdvance)
+    advM.setflags(write=False)
+    return advM
     
 def getAdvance(initS1, pAdvance, numFlashes=5):
     """Given the initial s-states and the number of flashes to consider
     initS1: Initial population in the S1 state
     pAdvance: Percent of population that advances 
     numFlashes: Number of laser flashes to advance the states
+    Arrays of initS1 and pAdvance give the advancement for the whole grid (..., numFlashes+1, 4)
     """
+    if np.ndim(initS1) == 0 and np.ndim(pAdvance) == 0:
+        return(_cachedAdvance(float(initS1), float(pAdvance), numFlashes))
     return(sStateAdvancement(sStatePopulation(initS1, pAdvance, numFlashes),pAdvance))
     
+def getAdvanceGrad(initS1, pAdvance, numFlashes=5):
+    """Same as getAdvance but also returns the derivatives of the advancement matrix
+    initS1: Initial population in the S1 state
+    pAdvance: Percent of population that advances 
+    numFlashes: Number of laser flashes to advance the states
+    returns (advancement, d advancement/d initS1, d advancement/d pAdvance)
+    """
+    sStatePop = sStatePopulation(initS1, pAdvance, numFlashes)
+    #the population is linear in initS1
+    dPopInit = sStatePopulation(1, pAdvance, numFlashes)-sStatePopulation(0, pAdvance, numFlashes)
+    #d(M**f)/dp = f M**(f-1) (P-I)
+    dPopP = np.zeros_like(sStatePop)
+    dPopP[...,1:,:] = np.arange(1,numFlashes+1)[:,None]*(np.roll(sStatePop[...,:-1,:], 1, axis=-1)-sStatePop[...,:-1,:])
+    p = np.asarray(pAdvance, dtype=float)[...,None,None]
+    return(sStatePop*p, dPopInit*p, dPopP*p+sStatePop)
+
 def get_flashModel(s3Model):    
     """This function changes which model is used for fitting the S3 model
     S3Model: function to model the S3-S0 Transition"""
-    def flashModel(t,  tauS01, tauS12, tauS23, tau1S30, tau2S30, ampS01, ampS12, ampS23=None,  amp2S30=None, amp1S30=None):
+    def flashModel(t,  tauS01, tauS12, tauS23, tau1S30, tau2S30, ampS01, ampS12, ampS23=None,  amp2S30=None, amp1S30=None, out=None):
         """
         This function calculates all s-state advancements which are used for fitting flash transitions elsewhere
-        t in this case is just the range of x-values used in the fit (ie not a list)
+        t in this case is just the range of x-values used in the fit (ie not a list, but it can be packed flashes)
         This assumes the S0 is the final state in the transition S3 to S0
+        out: optional (4, len(t)) buffer to fill
+        returns the transition basis (4, len(t)), one row per transition [S0-S1,S1-S2,S2-S3,S3-S0]
         """
-        valuesS = np.zeros((np.shape(t)[0],4))
+        valuesS = np.empty((4,np.shape(t)[0])) if out is None else out
         #The value contributions based on the S-state contributions
         #S0 to S1 uses the index 0
         valuesS[0] = singleRate(t, ampS01, tauS01)
@@ -112,29 +235,103 @@ def get_flashModel(s3Model):
         return valuesS
     return(flashModel)
 
+def packFlashes(listIn):
+    """Joins a list of per flash arrays into one array (a 1D array is assumed to be packed already)
+    listIn: list of arrays, one per flash"""
+    if isinstance(listIn, np.ndarray) and listIn.ndim == 1:
+        return listIn.astype(float, copy=False)
+    return np.concatenate([np.asarray(flash, dtype=float) for flash in listIn])
+
+def flashSlices(t):
+    """Finds each flash in a packed time array, every flash starts where the time resets
+    t: packed times (see packFlashes)
+    returns a list of slices, one per flash"""
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(t) <= 0)+1, [len(t)]))
+    return [slice(starts[i], starts[i+1]) for i in range(len(starts)-1)]
+
+def flashIndex(t):
+    """Flash number of every point in a packed time array
+    t: packed times (see packFlashes)"""
+    return np.repeat(np.arange(len(flashSlices(t))), [flash.stop-flash.start for flash in flashSlices(t)])
+
+def _packedAxis(cache, tList):
+    """Packs tList and builds the flash index and work buffers once, reusing them while the same tList is passed
+    cache: dict kept by the model closure
+    tList: times for each flash (or packed)"""
+    if cache.get('tList') is not tList:
+        t = packFlashes(tList)
+        cache.clear()
+        cache.update(tList=tList, t=t, flashIdx=flashIndex(t),
+                     basis=np.empty((4,len(t))), advWeights=np.empty((4,len(t))))
+    return cache
+
+#order of the arguments of totalModel after tList
+modelParams = ['initS1', 'pAdvance', 'tauS01', 'tauS12', 'tauS23', 'tau1S30', 'tau2S30',
+               'ampS01', 'ampS12', 'ampS23', 'amp2S30', 'amp1S30']
+
 def makeTotalModel(s3Model):
     """Creates the full function to fit, the advancement probability, the amplitudes and the time constants for each state
-    s3Model: model for the S3-S0 transition"""
+    s3Model: model for the S3-S0 transition
+    The returned model keeps its packed time axis and buffers between calls, so share it between processes not threads"""
     flashModel = get_flashModel(s3Model)
+    cache = {}
     def totalModel(tList, initS1, pAdvance, tauS01, tauS12, tauS23, tau1S30, tau2S30, ampS01, ampS12, ampS23, amp2S30, amp1S30):
         """The model that will be fit, contains all variables for the states and advancement probability.
         All states are single rate transitions except S3
-        tList: List of times 
+        tList: List of times for each flash or the same times packed into one array
         initS1: the initial population of the S1 state
         pAdvance: the fractional probability of each state advancing
         tauSxx: the time constant for the transition Sxx (ie S30 is S3-S0) and used in the models
-        ampSxx: the amplitude for the transition between Sxx"""
+        ampSxx: the amplitude for the transition between Sxx
+        returns the model for all flashes packed into one array"""
+        axis = _packedAxis(cache, tList)
         advM = getAdvance(initS1, pAdvance)
-        #get the theoretical kinetics using the longest time duration in the data
-        tLongest = tList[np.argmax(tList)]
-        traceFits = flashModel(tLongest,  tauS01, tauS12, tauS23, tau1S30, tau2S30,ampS01, ampS12, ampS23,  amp2S30, amp1S30)
-        
-        values = np.zeros(np.shape(tList))
-        
-        for i in range(len(tList)):
-            values[i] = advM[i,1]*traceFits[:,:len(tList[i])]
-        return values
+        #the transitions are evaluated once over every flash and weighted by that flash's advancement
+        basis = flashModel(axis['t'],  tauS01, tauS12, tauS23, tau1S30, tau2S30,ampS01, ampS12, ampS23,  amp2S30, amp1S30, out=axis['basis'])
+        np.take(advM.T, axis['flashIdx'], axis=1, out=axis['advWeights'])
+        return np.einsum('ij,ij->j', basis, axis['advWeights'])
     return(totalModel)
+
+def makeTotalGradient(s3Model):
+    """Creates the function giving the partial derivatives of the model from makeTotalModel
+    s3Model: model for the S3-S0 transition (must be in modelGradients)"""
+    s3Grad = modelGradients[s3Model]
+    flashModel = get_flashModel(s3Model)
+    cache = {}
+    def totalGradient(tList, initS1, pAdvance, tauS01, tauS12, tauS23, tau1S30, tau2S30, ampS01, ampS12, ampS23, amp2S30, amp1S30):
+        """Same arguments as totalModel
+        returns a dict of {parameter name: derivative of the packed model}"""
+        axis = _packedAxis(cache, tList)
+        t, flashIdx = axis['t'], axis['flashIdx']
+        advM, dAdvInit, dAdvP = getAdvanceGrad(initS1, pAdvance)
+        basis = flashModel(t, tauS01, tauS12, tauS23, tau1S30, tau2S30, ampS01, ampS12, ampS23, amp2S30, amp1S30, out=axis['basis'])
+        advWeights = np.take(advM.T, flashIdx, axis=1, out=axis['advWeights'])
+        dModel = {'initS1': np.einsum('ij,ji->i', dAdvInit[flashIdx], basis),
+                  'pAdvance': np.einsum('ij,ji->i', dAdvP[flashIdx], basis)}
+        for s, (name, amp, tau) in enumerate([('S01', ampS01, tauS01), ('S12', ampS12, tauS12), ('S23', ampS23, tauS23)]):
+            grad = singleRateGrad(t, amp, tau)
+            dModel['amp'+name] = advWeights[s]*grad[0]
+            dModel['tau'+name] = advWeights[s]*grad[2]
+        grad = s3Grad(t, amp1=amp1S30, amp2=amp2S30, tau1=tau1S30, tau2=tau2S30)
+        for g, name in enumerate(['amp1S30', 'amp2S30', 'tau1S30', 'tau2S30']):
+            dModel[name] = advWeights[3]*grad[g]
+        return dModel
+    return(totalGradient)
+
+def makeTotalJacobian(s3Model):
+    """Creates the analytic Jacobian of the residual of the model from makeTotalModel
+    s3Model: model for the S3-S0 transition (must be in modelGradients)"""
+    totalGradient = makeTotalGradient(s3Model)
+    def totalJacobian(params, data, weights, tList):
+        """Jacobian of (data-model)*weights with respect to the varied parameters in params
+        Called by lmfit in place of finite differences, the columns follow the order of the varied params"""
+        dModel = totalGradient(tList, **dict((name, params[name].value) for name in modelParams))
+        varNames = [name for name in params if params[name].vary and not params[name].expr]
+        jac = -np.array([dModel[name] for name in varNames]).T
+        if weights is not None:
+            jac *= np.asarray(weights)[:,None]
+        return jac
+    return(totalJacobian)
     
 def getParams(yData,paramDict):
     """Gets the parameters for initial guesses
@@ -158,17 +355,647 @@ def getParams(yData,paramDict):
 
     return params
 
-def fitData(xData, yData, weightList, s3Model, paramD):
+def seedAdvance(xData, yData, weightList, s3Model, paramD, numGrid=51):
+    """Grid search of initS1 and pAdvance with the kinetics held at the initial guesses from getParams
+    The model is linear in the advancement so each flash reduces to a 4 vector and 4x4 matrix and the whole grid is scored at once
+    xData, yData, weightList, s3Model, paramD: as for fitData
+    numGrid: number of grid points along initS1 and pAdvance (inside the bounds in paramD)
+    returns (best initS1, best pAdvance, initS1 grid, pAdvance grid, chi squared on the grid)"""
+    params = getParams(yData, paramD)
+    p = dict((name, params[name].value) for name in modelParams)
+    t, y, w = packFlashes(xData), packFlashes(yData), packFlashes(weightList)
+    flashIdx = flashIndex(t)
+    numFlashes = flashIdx[-1]+1
+    basis = get_flashModel(s3Model)(t, p['tauS01'], p['tauS12'], p['tauS23'], p['tau1S30'], p['tau2S30'],
+                                    p['ampS01'], p['ampS12'], p['ampS23'], p['amp2S30'], p['amp1S30'])
+    w2 = w*w
+    #chi2 of flash f for advancement row a is yy[f] - 2 a.by[f] + a.bb[f].a
+    yy = np.bincount(flashIdx, w2*y*y, minlength=numFlashes)
+    by = np.array([np.bincount(flashIdx, w2*y*b, minlength=numFlashes) for b in basis]).T
+    bb = np.array([[np.bincount(flashIdx, w2*b1*b2, minlength=numFlashes) for b2 in basis] for b1 in basis]).transpose(2,0,1)
+
+    def grid(name):
+        lo = 0. if params[name].min is None or not np.isfinite(params[name].min) else max(params[name].min, 0.)
+        hi = 1. if params[name].max is None or not np.isfinite(params[name].max) else min(params[name].max, 1.)
+        return lo+(hi-lo)*(np.arange(numGrid)+0.5)/numGrid #cell centres so the seed is never on a bound
+    initGrid, pGrid = grid('initS1'), grid('pAdvance')
+    adv = getAdvance(initGrid[:,None], pGrid[None,:], numFlashes)[...,:numFlashes,:]
+    chi2 = yy.sum()-2*np.einsum('abfs,fs->ab', adv, by)+np.einsum('abfs,fsr,abfr->ab', adv, bb, adv)
+    best = np.unravel_index(np.argmin(chi2), chi2.shape)
+    return(initGrid[best[0]], pGrid[best[1]], initGrid, pGrid, chi2)
+
+def fitData(xData, yData, weightList, s3Model, paramD, jacobian=True, seedGrid=None, params=None):
     """Fits x, Y data with weights on the initial data points according to the weightList
     xData, yData: x and y data for the absorption
     weightList: weighted list for weighting data in yData during fitting
-    s3Model: model for S3-S0 transition
-    paramD: parameters for fitting"""
-    modelUse = makeTotalModel(s3Model)
+    s3Model: model for the S3-S0 transition
+    paramD: parameters for fitting
+    jacobian: use the analytic Jacobian when s3Model has one in modelGradients (otherwise finite differences)
+    seedGrid: if given, start initS1 and pAdvance from a seedAdvance grid search with this many points per axis
+    params: lmfit.Parameters to start from (ie fit.params of an earlier fit) instead of getParams(yData, paramD)"""
+    modelUse = mi.timed('model', makeTotalModel(s3Model))
     fitModel = lmfit.Model(modelUse)
-    paramsIn = getParams(yData,paramD)
-    fit = fitModel.fit(yData, t=xData, params=paramsIn, method='leastsq', weights=weightList)
+    paramsIn = getParams(yData,paramD) if params is None else params.copy()
+    if seedGrid:
+        with mi.stage('seedAdvance'):
+            paramsIn['initS1'].value, paramsIn['pAdvance'].value = seedAdvance(xData, yData, weightList, s3Model, paramD, seedGrid)[:2]
+    fitKws = {}
+    if jacobian and s3Model in modelGradients:
+        fitKws['Dfun'] = mi.timed('jacobian', makeTotalJacobian(s3Model))
+    with mi.stage('fitData'):
+        fit = fitModel.fit(packFlashes(yData), tList=packFlashes(xData), params=paramsIn, method='leastsq',
+                           weights=packFlashes(weightList), fit_kws=fitKws)
+    mi.event('fitData', model=modelName(s3Model), nfev=fit.nfev, success=fit.success, redchi=fit.redchi)
     return(fit)
-    
-    
-       
\ No newline at end of file
+
+#S3-S0 models compared by compareModels unless others are given
+s3Models = [singleRate, sequentialRate, simultaneousRates, sequentialExp]
+
+def freezeUnusedParams(params, s3Model):
+    """Stops amp2S30 and tau2S30 from varying when s3Model ignores them (ie singleRate) so they do not count as fit parameters
+    params: lmfit.Parameters, changed in place
+    s3Model: model for the S3-S0 transition"""
+    t = np.linspace(0, 3000, 31)
+    base = dict(amp1=1., amp2=-1., tau1=50., tau2=1300.)
+    for arg, name in [('amp2', 'amp2S30'), ('tau2', 'tau2S30')]:
+        changed = dict(base)
+        changed[arg] *= 1.5
+        if np.allclose(s3Model(t, **base), s3Model(t, **changed)):
+            params[name].vary = False
+    return params
+
+def modelName(s3Model):
+    """Name used to report an S3-S0 model"""
+    return getattr(s3Model, '__name__', None) or getattr(getattr(s3Model, 'func', None), '__name__', repr(s3Model))
+
+def _fitSummary(xData, yData, weightList, s3Model, paramD, fitKws, start=None, fixed=None):
+    """Fits one model and returns the statistics as plain values (fit results hold closures so cannot be sent between processes)
+    start: optional dict of starting values replacing the initial guesses
+    fixed: optional dict of values for parameters held fixed"""
+    params = freezeUnusedParams(getParams(yData, paramD), s3Model)
+    for name, value in (start or {}).items():
+        params[name].value = value
+    for name, value in (fixed or {}).items():
+        params[name].set(value=value, vary=False)
+    fit = fitData(xData, yData, weightList, s3Model, paramD, params=params, **fitKws)
+    return {'model': modelName(s3Model), 'chisqr': fit.chisqr, 'redchi': fit.redchi, 'aic': fit.aic, 'bic': fit.bic,
+            'nvarys': fit.nvarys, 'ndata': fit.ndata, 'success': fit.success, 'nfev': fit.nfev,
+            'values': dict((name, par.value) for name, par in fit.params.items()),
+            'stderr': dict((name, par.stderr) for name, par in fit.params.items())}
+
+def compareModels(xData, yData, weightList, paramD, models=None, workers=None, rankBy='aic', **fitKws):
+    """Fits every S3-S0 model to the same conditioned data in a process pool and ranks them
+    xData, yData, weightList: conditioned data as for fitData
+    paramD: parameters for fitting
+    models: S3-S0 model functions (or a dict of name: function) to compare, default s3Models
+        They are sent to the worker processes so must be importable (module level functions or partials of them)
+    workers: number of processes (None uses every core, 1 fits in this process)
+    rankBy: statistic to rank by ('aic', 'bic' or 'chisqr')
+    fitKws: passed on to fitData (ie seedGrid)
+    returns a list of dicts (model, chisqr, redchi, aic, bic, nvarys, values, stderr ...) best first,
+    with the difference to the best model in 'd'+rankBy"""
+    if models is None:
+        models = s3Models
+    names = list(models.keys()) if isinstance(models, dict) else [modelName(model) for model in models]
+    models = list(models.values()) if isinstance(models, dict) else list(models)
+
+    if workers == 1:
+        table = [_fitSummary(xData, yData, weightList, model, paramD, fitKws) for model in models]
+    else:
+        with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = [pool.submit(_fitSummary, xData, yData, weightList, model, paramD, fitKws) for model in models]
+            table = [job.result() for job in jobs]
+    for name, row in zip(names, table):
+        row['model'] = name
+    table.sort(key=lambda row: row[rankBy])
+    for row in table:
+        row['d'+rankBy] = row[rankBy]-table[0][rankBy]
+    return table
+
+_bootstrapState = {}
+
+def _initBootstrap(state):
+    """Stores the data shared by every replicate once per worker process"""
+    _bootstrapState.clear()
+    _bootstrapState.update(state)
+
+def _bootstrapData(state, rng):
+    """Makes the data for one replicate
+    returns (xData, yData, weightList) as lists per flash"""
+    if state['method'] == 'files':
+        import Model_TRXAS_Data as md
+        counts = rng.multinomial(len(state['traces']), np.ones(len(state['traces']))/len(state['traces']))
+        accumulator = md.AlignedSum()
+        for count, (trace, flashTimes) in zip(counts, state['traces']):
+            if count:
+                accumulator.add(trace*count, None, flashTimes)
+        inputData, _, flashTimes = accumulator.result()
+        return md.conditionData(inputData, flashTimes, **state['conditionArgs'])[:3]
+    slices = flashSlices(state['t'])
+    if state['method'] == 'residuals':
+        #residuals over their bin noise are exchangeable within a flash, each is put back at the noise of its new bin
+        yNew = state['bestFit'].copy()
+        for flash in slices:
+            scaled = state['scaled'][flash]
+            yNew[flash] += scaled[rng.randint(0, len(scaled), len(scaled))]*state['noise'][flash]
+    else:
+        yNew = state['bestFit']+rng.normal(0., 1., len(state['t']))*state['noise']
+    return ([state['t'][flash] for flash in slices], [yNew[flash] for flash in slices],
+            [state['w'][flash] for flash in slices])
+
+#errors of a replicate fit that count as a failed replicate, anything else (ie bad arguments) is raised
+fitErrors = (ValueError, FloatingPointError, ZeroDivisionError, np.linalg.LinAlgError)
+
+def _bootstrapChunk(seeds):
+    """Fits the replicates for a list of seeds in a worker, failed fits are returned as their error message"""
+    state = _bootstrapState
+    out = []
+    for seed in seeds:
+        rng = np.random.RandomState(seed)
+        xData, yData, weightList = _bootstrapData(state, rng)
+        try:
+            fit = fitData(xData, yData, weightList, state['s3Model'], state['paramD'], params=state['params'])
+        except fitErrors as err:
+            out.append('{}: {}'.format(type(err).__name__, err))
+            continue
+        out.append([fit.params[name].value for name in state['names']])
+    return out
+
+def _resampleState(fit, method, noise):
+    """The part of the bootstrap state _bootstrapData needs for 'residuals' and 'montecarlo' (see iterBootstrap)
+    returns a dict of the packed times, weights, best fit, noise of every point and residuals over that noise"""
+    t = fit.userkws['tList']
+    if method == 'montecarlo' and noise is None:
+        raise Exception('montecarlo resampling needs the noise standard deviation')
+    if noise is None:
+        if any(len(t[flash]) > 2 and np.ptp(np.diff(t[flash])) > 1e-6*np.ptp(t[flash]) for flash in flashSlices(t)):
+            warnings.warn('residuals of unequal bins are resampled without their bin noise, pass noise')
+        noise = 1.
+    elif not np.isscalar(noise):
+        noise = np.concatenate(noise) if isinstance(noise, (list, tuple)) else np.asarray(noise, dtype=float)
+    noise = noise*np.ones(len(t))
+    return {'t': t, 'w': fit.weights, 'bestFit': fit.best_fit, 'noise': noise, 'scaled': (fit.data-fit.best_fit)/noise}
+
+def iterBootstrap(fit, s3Model, paramD, method='residuals', numReplicates=1000, noise=None, files=None,
+                  conditionArgs=None, loadArgs=None, workers=None, chunkSize=10, seed=None,
+                  percentiles=(2.5, 50., 97.5), reportEvery=50, maxFailures=0.2):
+    """Resamples the data, refits every replicate starting from fit and yields the percentile intervals as they build up
+    fit: the fit to the full data (from fitData), its data, weights and params are reused
+    s3Model: model for the S3-S0 transition
+    paramD: parameters for fitting
+    method: 'residuals' resamples the residuals within each flash,
+        'montecarlo' adds normal noise with standard deviation noise to the best fit,
+        'files' resamples the input files (needs files and the conditionArgs used for getData)
+    numReplicates: number of replicates
+    noise: noise standard deviation, a scalar or per point (a list per flash or packed like the fit data),
+        for 'montecarlo' (ie Std from getData, over sqrt(timeBin) when binned) and for 'residuals' when the bins
+        differ in noise (the bin noise from getData(..., returnNoise=True) with log binning, not the weights that
+        include weightFactor)
+    files, conditionArgs, loadArgs: for 'files', the h5 files, conditionData and loadData arguments
+    workers: number of processes (None uses every core, 1 runs in this process)
+    chunkSize: replicates sent to a worker at a time
+    seed: base seed so the replicates can be repeated
+    percentiles: percentiles reported for each parameter
+    reportEvery: yield after at least this many more replicates have finished
+    maxFailures: largest fraction of replicate fits allowed to fail (checked once reportEvery replicates are done),
+        an error is raised past it or if every fit of the first chunk fails
+    yields (samples, intervals) with samples an array (replicates done, parameters) and
+    intervals a dict of {parameter: percentiles}
+    """
+    names = [name for name in fit.params if fit.params[name].vary]
+    state = {'method': method, 's3Model': s3Model, 'paramD': paramD, 'params': fit.params, 'names': names}
+    if method == 'files':
+        import Model_TRXAS_Data as md
+        loadArgs = loadArgs or {}
+        traces = []
+        for fileIn in files:
+            trace, _, flashTimes = md.loadData(fileIn, **loadArgs)
+            traces.append((np.asarray(trace, dtype=float), flashTimes))
+        state.update(traces=traces, conditionArgs=conditionArgs or {})
+    elif method in ('residuals', 'montecarlo'):
+        state.update(_resampleState(fit, method, noise))
+    else:
+        raise Exception('Unknown resampling method: {}'.format(method))
+
+    if seed is None:
+        seed = np.random.randint(2**31)
+    seeds = [[seed, i] for i in range(numReplicates)]
+    chunks = [seeds[i:i+chunkSize] for i in range(0, numReplicates, chunkSize)]
+    samples = []
+    lastReport = 0
+
+    def report():
+        done = np.array([sample for sample in samples if not isinstance(sample, str)])
+        intervals = {}
+        if len(done):
+            values = np.percentile(done, percentiles, axis=0)
+            intervals = dict((name, values[:,i]) for i, name in enumerate(names))
+        return done, intervals
+
+    if workers == 1:
+        _initBootstrap(state)
+        results = (_bootstrapChunk(chunk) for chunk in chunks)
+        pool = None
+    else:
+        pool = futures.ProcessPoolExecutor(max_workers=workers, initializer=_initBootstrap, initargs=(state,))
+        results = (job.result() for job in futures.as_completed([pool.submit(_bootstrapChunk, chunk) for chunk in chunks]))
+    try:
+        failed = []
+        for chunkResult in results:
+            samples.extend(chunkResult)
+            failed.extend(sample for sample in chunkResult if isinstance(sample, str))
+            if len(failed) == len(samples) or (len(samples) >= reportEvery and len(failed) > maxFailures*len(samples)):
+                raise Exception('{} of {} bootstrap fits failed, last error {}'.format(len(failed), len(samples), failed[-1]))
+            if len(samples)-lastReport >= reportEvery:
+                lastReport = len(samples)
+                yield report()
+        if failed:
+            warnings.warn('{} of {} bootstrap fits failed and were left out, last error {}'.format(
+                len(failed), len(samples), failed[-1]))
+        if lastReport != len(samples):
+            yield report()
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+def bootstrapFit(fit, s3Model, paramD, tol=None, callback=None, **bootstrapArgs):
+    """Bootstrap (or Monte-Carlo) percentile intervals for the fit parameters, see iterBootstrap for the arguments
+    tol: stop early once no interval end moves by more than tol times the interval width between reports
+    callback: called with (samples, intervals) at every report
+    returns (samples, intervals) from the last report"""
+    last = None
+    samples, intervals = np.zeros((0, 0)), {}
+    for samples, intervals in iterBootstrap(fit, s3Model, paramD, **bootstrapArgs):
+        if callback is not None:
+            callback(samples, intervals)
+        if tol is not None and last is not None and intervals:
+            moved = max(np.max(np.abs(intervals[name]-last[name]))/max(np.ptp(intervals[name]), 1e-300) for name in intervals)
+            if moved < tol:
+                break
+        last = intervals
+    return samples, intervals
+
+def sampleStarts(params, names, numStarts, sampler='sobol', seed=None):
+    """Starting values spread over the parameter bounds by a quasi random design
+    params: lmfit.Parameters with the bounds and initial guesses
+    names: parameters to sample
+    numStarts: number of starting points
+    sampler: 'sobol' or 'lhs' (latin hypercube)
+    seed: seed for the design
+    Parameters without a finite bound are sampled from a tenth to ten times their initial guess (log spaced when positive)
+    returns a list of dicts of starting values"""
+    from scipy.stats import qmc
+    design = qmc.Sobol(len(names), seed=seed) if sampler == 'sobol' else qmc.LatinHypercube(len(names), seed=seed)
+    unit = design.random(numStarts)
+    starts = [dict() for _ in range(numStarts)]
+    for i, name in enumerate(names):
+        par = params[name]
+        lo, hi = par.min, par.max
+        guess = abs(par.value) if par.value else 1.
+        if np.isfinite(lo) and np.isfinite(hi):
+            values = lo+(hi-lo)*unit[:,i]
+        elif (not np.isfinite(lo) or lo >= 0) and par.value > 0:
+            #log spaced around the guess, clipped to the one finite bound
+            values = np.clip(par.value*10**(2*unit[:,i]-1), lo, hi)
+        else:
+            values = np.clip(par.value+guess*10*(2*unit[:,i]-1), lo, hi)
+        #keep the starts off the bounds where the bounded transform has no gradient
+        width = hi-lo if np.isfinite(hi-lo) else guess
+        values = np.clip(values, lo+1e-6*width, hi-1e-6*width)
+        for start, value in zip(starts, values):
+            start[name] = value
+    return starts
+
+def _sameMinimum(a, b, names, rtol, ptol):
+    """Whether two fit summaries are the same minimum
+    Swapping the two S3-S0 time constants (with matching amplitudes) gives the same curve so the S3-S0 amplitudes
+    are not compared and the time constants are compared as a pair"""
+    if abs(a['chisqr']-b['chisqr']) > rtol*max(abs(a['chisqr']), 1e-300):
+        return False
+    names = [name for name in names if name not in ('amp1S30', 'amp2S30', 'tau1S30', 'tau2S30')]
+    valuesA = [a['values'][name] for name in names]+sorted([a['values']['tau1S30'], a['values']['tau2S30']])
+    valuesB = [b['values'][name] for name in names]+sorted([b['values']['tau1S30'], b['values']['tau2S30']])
+    return np.allclose(valuesA, valuesB, rtol=ptol, atol=0)
+
+def multiStartFit(xData, yData, weightList, s3Model, paramD, numStarts=32, sampler='sobol', workers=None,
+                  patience=3, rtol=1e-6, ptol=1e-2, seed=None, **fitKws):
+    """Runs fitData from many starting points in a process pool and returns the distinct minima found
+    xData, yData, weightList, s3Model, paramD: as for fitData
+    numStarts: number of starting points, drawn by sampleStarts from the bounds of the parameters in paramD
+    sampler: 'sobol' or 'lhs'
+    workers: number of processes (None uses every core, 1 fits in this process)
+    patience: stop once the best chi squared has been found this many times (None runs every start)
+    rtol: relative chi squared difference under which two minima count as the same
+    ptol: relative parameter difference under which two minima count as the same
+    seed: seed for the starting design
+    fitKws: passed on to fitData
+    returns a list of minima best first, each the fit summary (chisqr, aic, values, ...) with the number of starts
+    that reached it ('count') and the first start that did ('start')"""
+    params = freezeUnusedParams(getParams(yData, paramD), s3Model)
+    names = [name for name in paramD if params[name].vary]
+    starts = sampleStarts(params, names, numStarts, sampler=sampler, seed=seed)
+    varied = [name for name in params if params[name].vary]
+    minima = []
+
+    def addResult(start, summary):
+        """Adds a fit to the minima and returns True once the best has been found patience times"""
+        summary['count'], summary['start'] = 1, start
+        for known in minima:
+            if _sameMinimum(summary, known, varied, rtol, ptol):
+                known['count'] += 1
+                break
+        else:
+            minima.append(summary)
+        minima.sort(key=lambda row: row['chisqr'])
+        return patience is not None and minima[0]['count'] >= patience
+
+    if workers == 1:
+        for start in starts:
+            if addResult(start, _fitSummary(xData, yData, weightList, s3Model, paramD, fitKws, start)):
+                break
+    else:
+        pool = futures.ProcessPoolExecutor(max_workers=workers)
+        try:
+            jobs = dict((pool.submit(_fitSummary, xData, yData, weightList, s3Model, paramD, fitKws, start), i)
+                        for i, start in enumerate(starts))
+            for job in futures.as_completed(jobs):
+                if addResult(starts[jobs[job]], job.result()):
+                    break
+        finally:
+            #return without waiting for the fits still running once the best minimum has been found
+            pool.shutdown(wait=False, cancel_futures=True)
+    return minima
+
+def _profileOrder(shape, first):
+    """Groups the grid points into rings of growing distance (in grid steps) from first
+    Every point of a ring has a neighbour in the ring before it, so a ring can be fit in parallel from the last one
+    returns a list of rings, each a list of index tuples"""
+    idx = np.indices(shape).reshape((len(shape), -1)).T
+    dist = np.abs(idx-np.asarray(first)).max(axis=1)
+    return [[tuple(i) for i in idx[dist == d]] for d in range(dist.max()+1)]
+
+def _profileChains(size, first, numChains):
+    """Splits a one parameter grid into chains that each walk away from first
+    The chains on either side of first start next to it, the others start where the chain before them ends
+    (at least one chain per side of first)
+    returns a list of chains, each a list of indices in the order they are fit"""
+    left, right = list(range(first, -1, -1)), list(range(first+1, size))
+    numLeft = min(len(left), max(1, int(round(numChains*len(left)/float(size)))), max(1, numChains-1 if right else numChains))
+    numRight = min(len(right), max(1, numChains-numLeft)) if right else 0
+    chains = np.array_split(left, numLeft)+(np.array_split(right, numRight) if right else [])
+    return [[int(k) for k in chain] for chain in chains]
+
+def _profileChain(xData, yData, weightList, s3Model, paramD, fitKws, start, name, values):
+    """Fits the profile points of one chain in order, each starting from the fit of the point before it
+    start: starting values for the first point
+    name, values: the profiled parameter and its grid values along the chain
+    returns a list of fit summaries"""
+    out = []
+    for value in values:
+        out.append(_fitSummary(xData, yData, weightList, s3Model, paramD, fitKws, start, {name: value}))
+        start = dict((par, parValue) for par, parValue in out[-1]['values'].items() if par != name)
+    return out
+
+def profileFit(xData, yData, weightList, s3Model, paramD, grids, best=None, workers=None, scale=False,
+               confidence=(0.683, 0.954), chains=None, **fitKws):
+    """
+    Likelihood profile (chi squared surface) over one or two parameters
+    At each grid point the chosen parameters are fixed and the rest refit, starting from the converged fit of
+    a neighbouring grid point. Points are fit ring by ring outwards from the point nearest the best fit,
+    the points of each ring in parallel. A ring of one parameter holds at most 2 points, so one parameter grids
+    are instead split into chains (see chains) that are fit in parallel, each point from the one before it.
+    xData, yData, weightList, s3Model, paramD: as for fitData
+    grids: dict of {parameter: grid values} for one or two parameters (ie {'tau1S30': np.linspace(20, 200, 50)})
+    best: best fit to start from (an lmfit result or a fit summary dict with 'values'), fit here by default
+    workers: number of processes (None uses every core, 1 fits in this process)
+    scale: divide the chi squared differences by the reduced chi squared of the best fit (when the weights
+        do not give a reduced chi squared near 1)
+    confidence: confidence levels for the intervals (one parameter) or contours (two parameters)
+    chains: number of chains a one parameter grid is split into (default the number of workers)
+        The two chains next to the best fit start from it, the others from the best fit values at their first point,
+        so use chains=2 to warm start every point (then at most 2 fits run at once)
+    fitKws: passed on to fitData (seedGrid is ignored so it cannot move a fixed pAdvance or initS1)
+    returns a dict with the names, grids, chisqr and deltaChi2 arrays (one axis per parameter), the refit
+    values ({parameter: array}), success array, the best fit values and, for each confidence level, its
+    chi squared difference and the interval or contour lines
+    """
+    fitKws.pop('seedGrid', None)
+    names = list(grids)
+    if len(names) not in (1, 2):
+        raise Exception('Profiles are over one or two parameters, not {}'.format(len(names)))
+    gridList = [np.asarray(grids[name], dtype=float) for name in names]
+    shape = tuple(len(grid) for grid in gridList)
+    if best is None:
+        best = _fitSummary(xData, yData, weightList, s3Model, paramD, fitKws)
+    elif not isinstance(best, dict):
+        best = {'chisqr': best.chisqr, 'redchi': best.redchi,
+                'values': dict((name, par.value) for name, par in best.params.items())}
+    first = tuple(int(np.argmin(np.abs(grid-best['values'][name]))) for name, grid in zip(names, gridList))
+
+    results = {}
+    def point(i):
+        """fit arguments for grid point i, starting from its best neighbour already fit"""
+        near = [results[j] for j in itertools.product(*[range(k-1, k+2) for k in i]) if j in results]
+        start = min(near, key=lambda row: row['chisqr'])['values'] if near else best['values']
+        start = dict((name, value) for name, value in start.items() if name not in names)
+        fixed = dict((name, grid[k]) for name, grid, k in zip(names, gridList, i))
+        return (i, (xData, yData, weightList, s3Model, paramD, fitKws, start, fixed))
+
+    if chains is None:
+        chains = 1 if workers == 1 else (workers or os.cpu_count() or 1)
+    pool = None if workers == 1 else futures.ProcessPoolExecutor(max_workers=workers)
+    try:
+        if len(names) == 1 and chains > 2:
+            start = dict((name, value) for name, value in best['values'].items() if name not in names)
+            jobs = [(chain, (xData, yData, weightList, s3Model, paramD, fitKws, start, names[0], gridList[0][chain]))
+                    for chain in _profileChains(shape[0], first[0], chains)]
+            if pool is None:
+                done = [(chain, _profileChain(*args)) for chain, args in jobs]
+            else:
+                submitted = [(chain, pool.submit(_profileChain, *args)) for chain, args in jobs]
+                done = [(chain, job.result()) for chain, job in submitted]
+            for chain, rows in done:
+                results.update(((k,), row) for k, row in zip(chain, rows))
+        for ring in ([] if results else _profileOrder(shape, first)):
+            jobs = [point(i) for i in ring]
+            if pool is None:
+                done = [(i, _fitSummary(*args)) for i, args in jobs]
+            else:
+                submitted = [(i, pool.submit(_fitSummary, *args)) for i, args in jobs]
+                done = [(i, job.result()) for i, job in submitted]
+            results.update(done)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    chisqr = np.array([results[i]['chisqr'] for i in np.ndindex(shape)]).reshape(shape)
+    success = np.array([results[i]['success'] for i in np.ndindex(shape)]).reshape(shape)
+    values = dict((name, np.array([results[i]['values'][name] for i in np.ndindex(shape)]).reshape(shape))
+                  for name in best['values'])
+    minimum = min(best['chisqr'], chisqr.min())
+    deltaChi2 = chisqr-minimum
+    if scale:
+        deltaChi2 = deltaChi2/best['redchi']
+    profile = {'names': names, 'grids': gridList, 'chisqr': chisqr, 'deltaChi2': deltaChi2, 'values': values,
+               'success': success, 'best': best['values'], 'confidence': {}}
+    from scipy.stats import chi2
+    for level in confidence:
+        delta = chi2.ppf(level, len(names))
+        if len(names) == 1:
+            bestDelta = (best['chisqr']-minimum)/(best['redchi'] if scale else 1.)
+            interval = profileInterval(gridList[0], deltaChi2, delta, best=(best['values'][names[0]], bestDelta))
+            region = {'deltaChi2': delta, 'interval': interval}
+        else:
+            region = {'deltaChi2': delta, 'contours': profileContours(gridList, deltaChi2, delta)}
+        profile['confidence'][level] = region
+    return profile
+
+def profileInterval(grid, deltaChi2, delta, best=None):
+    """Interval around the minimum of a one parameter profile where deltaChi2 stays under delta
+    Each end is interpolated between the last point under delta and the first above it, as a parabola
+    when the last point is the minimum and linearly otherwise
+    grid, deltaChi2: one parameter profile
+    delta: chi squared difference for the confidence level
+    best: (value, deltaChi2) of the best fit, added to the profile so a coarse grid still brackets the minimum
+    returns (low, high), an end is nan where the profile does not reach delta in the grid and both are nan
+    when no point is under delta (the grid is too coarse)"""
+    grid, deltaChi2 = np.asarray(grid, dtype=float), np.asarray(deltaChi2, dtype=float)
+    if best is not None:
+        grid, deltaChi2 = np.append(grid, best[0]), np.append(deltaChi2, best[1])
+    order = np.argsort(grid, kind='mergesort')
+    grid, deltaChi2 = grid[order], deltaChi2[order]
+    lowest = int(np.argmin(deltaChi2))
+    if deltaChi2[lowest] > delta:
+        return(np.nan, np.nan)
+    ends = []
+    for side in (-1, 1):
+        i = lowest
+        while 0 <= i+side < len(grid) and deltaChi2[i+side] <= delta:
+            i += side
+        j = i+side
+        if not 0 <= j < len(grid):
+            ends.append(np.nan)
+        elif i == lowest:
+            ends.append(grid[i]+(grid[j]-grid[i])*np.sqrt((delta-deltaChi2[i])/(deltaChi2[j]-deltaChi2[i])))
+        else:
+            ends.append(np.interp(delta, [deltaChi2[i], deltaChi2[j]], [grid[i], grid[j]]))
+    return(ends[0], ends[1])
+
+def profileContours(grids, deltaChi2, delta):
+    """Contour lines of a two parameter profile at deltaChi2 == delta (uses contourpy, installed with matplotlib)
+    returns a list of arrays of (first parameter, second parameter) points"""
+    import contourpy
+    x, y = grids
+    return contourpy.contour_generator(x, y, np.asarray(deltaChi2).T).lines(delta)
+
+#parameters shared by every data set in fitDatasets, the rest (the amplitudes) belong to each data set
+sharedParams = ['initS1', 'pAdvance', 'tauS01', 'tauS12', 'tauS23', 'tau1S30', 'tau2S30']
+datasetParams = ['ampS01', 'ampS12', 'ampS23', 'amp2S30', 'amp1S30']
+
+def fitDatasets(datasets, s3Model, paramD, jacobian=True, **lsqKws):
+    """Global fit of many data sets (ie X-ray energies or sample preparations) sharing the kinetics and advancement
+    Each data set has its own amplitudes, so the Jacobian is block sparse: the rows of a data set only depend on the
+    shared parameters and that data set's amplitudes. scipy least_squares (trust region reflective with lsmr) is
+    given that structure so the cost grows about linearly with the number of data sets.
+    datasets: list of (xData, yData, weightList) as for fitData
+    s3Model: model for the S3-S0 transition
+    paramD: parameters for fitting (the shared parameters), amplitudes are guessed per data set by getParams
+    jacobian: use the analytic Jacobian when s3Model has one in modelGradients, otherwise finite differences
+        grouped by the sparsity pattern
+    lsqKws: passed on to scipy.optimize.least_squares
+    returns a dict with 'values' and 'stderr' for the shared parameters, 'amplitudes' and 'ampStderr'
+    (one dict per data set), 'chisqr', 'redchi', 'ndata', 'nfev', 'success' and the scipy 'result'
+    Parameters s3Model ignores (see freezeUnusedParams) are held at their starting values with a stderr of None"""
+    from scipy import optimize, sparse
+
+    #only the parameters the model uses are fit, the others would give all zero Jacobian columns
+    frozen = freezeUnusedParams(getParams(datasets[0][1], paramD), s3Model)
+    fitShared = [name for name in sharedParams if frozen[name].vary]
+    fitOwn = [name for name in datasetParams if frozen[name].vary]
+    nShared, nOwn = len(fitShared), len(fitOwn)
+    x0, lo, hi = [], [], []
+    for name in fitShared:
+        value, low, high = paramD[name]
+        x0.append(value)
+        lo.append(-np.inf if low is None else low)
+        hi.append(np.inf if high is None else high)
+    packed, models, fixed = [], [], []
+    for xData, yData, weightList in datasets:
+        guesses = getParams(yData, paramD)
+        x0.extend(guesses[name].value for name in fitOwn)
+        lo.extend([-np.inf]*nOwn)
+        hi.extend([np.inf]*nOwn)
+        fixed.append(dict((name, guesses[name].value) for name in sharedParams+datasetParams
+                          if name not in fitShared+fitOwn))
+        packed.append((packFlashes(xData), packFlashes(yData), packFlashes(weightList)))
+        models.append(makeTotalModel(s3Model))
+    lo, hi = np.array(lo, dtype=float), np.array(hi, dtype=float)
+    #trust region reflective needs a start strictly inside the bounds
+    x0 = np.array(x0, dtype=float)
+    margin = 1e-9*np.maximum(1, np.abs(x0))
+    x0 = np.clip(x0, lo+margin, hi-margin)
+    rowStarts = np.cumsum([0]+[len(t) for t, _, _ in packed])
+
+    def values(p, d):
+        own = p[nShared+d*nOwn:nShared+(d+1)*nOwn]
+        return dict(list(fixed[d].items())+list(zip(fitShared, p[:nShared]))+list(zip(fitOwn, own)))
+
+    def residual(p):
+        return np.concatenate([(y-models[d](t, **values(p, d)))*w for d, (t, y, w) in enumerate(packed)])
+
+    #each data set's rows touch the shared columns and its own amplitude columns
+    rows, cols = [], []
+    for d in range(len(packed)):
+        blockRows = np.arange(rowStarts[d], rowStarts[d+1])
+        blockCols = np.concatenate((np.arange(nShared), nShared+d*nOwn+np.arange(nOwn)))
+        rows.append(np.repeat(blockRows, len(blockCols)))
+        cols.append(np.tile(blockCols, len(blockRows)))
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    shape = (rowStarts[-1], len(x0))
+
+    if jacobian and s3Model in modelGradients:
+        gradients = [makeTotalGradient(s3Model) for _ in packed]
+        def jac(p):
+            blocks = []
+            for d, (t, y, w) in enumerate(packed):
+                dModel = gradients[d](t, **values(p, d))
+                blocks.append((-np.array([dModel[name] for name in fitShared+fitOwn])*w).T.ravel())
+            return sparse.csr_matrix((np.concatenate(blocks), (rows, cols)), shape=shape)
+        lsqKws.setdefault('jac', jac)
+    else:
+        lsqKws.setdefault('jac_sparsity', sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape))
+    lsqKws.setdefault('x_scale', 'jac')
+    if callable(lsqKws.get('jac')):
+        lsqKws['jac'] = mi.timed('jacobian', lsqKws['jac'])
+    with mi.stage('fitDatasets'):
+        result = optimize.least_squares(mi.timed('residual', residual), x0, bounds=(lo, hi), method='trf',
+                                        tr_solver='lsmr', **lsqKws)
+    mi.event('fitDatasets', model=modelName(s3Model), numDatasets=len(packed), nfev=result.nfev, njev=result.njev,
+             success=result.success)
+
+    chisqr = 2*result.cost
+    ndata, nvarys = len(result.fun), len(x0)
+    redchi = chisqr/max(ndata-nvarys, 1)
+    #errors only from the columns that move the residual, a dead column leaves just its own error as nan
+    stderr = np.full(nvarys, np.nan)
+    JTJ = sparse.csr_matrix(result.jac).T.dot(sparse.csr_matrix(result.jac)).toarray()
+    live = np.flatnonzero(np.diag(JTJ) > 0)
+    try:
+        stderr[live] = np.sqrt(np.diag(np.linalg.inv(JTJ[np.ix_(live, live)]))*redchi)
+    except np.linalg.LinAlgError:
+        pass
+    x, stderr = result.x.tolist(), stderr.tolist()
+
+    def named(names, start, valuesIn, d, fixedStderr=False):
+        out = dict(zip(names, valuesIn[start:start+len(names)]))
+        for name in (sharedParams if names is fitShared else datasetParams):
+            if name not in out:
+                out[name] = None if fixedStderr else fixed[d][name]
+        return out
+    return {'values': named(fitShared, 0, x, 0),
+            'stderr': named(fitShared, 0, stderr, 0, True),
+            'amplitudes': [named(fitOwn, nShared+d*nOwn, x, d) for d in range(len(packed))],
+            'ampStderr': [named(fitOwn, nShared+d*nOwn, stderr, d, True) for d in range(len(packed))],
+            'chisqr': chisqr, 'redchi': redchi, 'ndata': ndata, 'nfev': result.nfev, 'success': result.success,
+            'result': result}
+
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+Opt-in instrumentation of the data conditioning and fitting.
+Nothing is recorded unless a Run is open; with none open the hooks left in Model_TRXAS_Data and Model_TRXAS_Fit
+cost a single global lookup and timed returns the function it is given unchanged.
+A Run records per stage wall time (and peak traced allocations with memory=True), counters such as the bytes
+read from the h5 files, call counts and latencies of the model and Jacobian, and events such as the optimizer
+iterations of each fit. Stages run in worker processes (ie loadList with workers > 1) are not seen.
+
+Example:
+    with mi.Run(memory=True, outFile='run.json') as run:
+        xData, yData, weights, Std = md.getData(files)
+        fit = mf.fitData(xData, yData, weights, mf.sequentialRate, paramsDict)
+    run.report()['stages']['loadAligned']['seconds']
+"""
+import functools
+import json
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+_active = None #the open Run, None when instrumentation is off
+
+class _NullStage(object):
+    """Stage used when nothing is recorded"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_nullStage = _NullStage()
+
+def enabled():
+    """True while a Run is open"""
+    return _active is not None
+
+def stage(name):
+    """Context manager timing the code inside it as the stage name (nested stages are also counted in their parents)"""
+    if _active is None:
+        return _nullStage
+    return _Stage(_active, name)
+
+def add(name, value=1):
+    """Adds value to the counter name"""
+    if _active is not None:
+        _active.add(name, value)
+
+def event(name, **values):
+    """Records values (ie the numbers that used to be printed) under name"""
+    if _active is not None:
+        _active.event(name, values)
+
+def timed(name, fn):
+    """Wraps fn so its calls and latency are recorded under name, returns fn itself when nothing is recorded"""
+    run = _active
+    if run is None:
+        return fn
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            run.call(name, time.perf_counter()-start)
+    return wrapper
+
+def _plain(value):
+    """Converts numpy values so they can be written as JSON"""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return dict((str(k), _plain(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    return value
+
+class _Stage(object):
+    def __init__(self, run, name):
+        self.run = run
+        self.name = name
+
+    def __enter__(self):
+        self.frame = self.run.enterStage()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter()-self.start
+        self.run.exitStage(self.name, seconds, self.frame)
+        return False
+
+class Run(object):
+    """
+    Records the instrumentation of everything run while it is open (use as a context manager)
+    memory: also trace the peak memory allocated in each stage with tracemalloc (slows numpy allocation a little)
+    callback: called with the report when the run closes
+    outFile: JSON file the report is written to when the run closes
+    """
+    def __init__(self, memory=False, callback=None, outFile=None):
+        self.memory = memory
+        self.callback = callback
+        self.outFile = outFile
+        self.stages = {}
+        self.counters = {}
+        self.calls = {}
+        self.events = []
+        self.seconds = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._previous = None
+        self._startedTracing = False
+
+    def __enter__(self):
+        global _active
+        self._previous = _active
+        _active = self
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._startedTracing = True
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        self.seconds = time.perf_counter()-self._start
+        if self._startedTracing:
+            tracemalloc.stop()
+            self._startedTracing = False
+        _active = self._previous
+        report = self.report()
+        if self.outFile is not None:
+            with open(self.outFile, 'w') as f:
+                json.dump(report, f, indent=1)
+        if self.callback is not None:
+            self.callback(report)
+        return False
+
+    def enterStage(self):
+        """Starts a stage frame, the peak so far is handed to the enclosing stage before the peak is reset"""
+        stack = self._local.__dict__.setdefault('stack', [])
+        frame = {'base': 0, 'peak': 0}
+        if self.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            frame['base'] = current
+        stack.append(frame)
+        return frame
+
+    def exitStage(self, name, seconds, frame):
+        stack = self._local.stack
+        stack.pop()
+        peakBytes = None
+        if self.memory and tracemalloc.is_tracing():
+            _, peak = tracemalloc.get_traced_memory()
+            peak = max(frame['peak'], peak)
+            peakBytes = peak-frame['base']
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+        with self._lock:
+            entry = self.stages.setdefault(name, {'calls': 0, 'seconds': 0., 'peakBytes': None})
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            if peakBytes is not None:
+                entry['peakBytes'] = max(entry['peakBytes'] or 0, peakBytes)
+
+    def add(self, name, value):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0)+value
+
+    def call(self, name, seconds):
+        with self._lock:
+            entry = self.calls.setdefault(name, {'count': 0, 'seconds': 0., 'maxSeconds': 0.})
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['maxSeconds'] = max(entry['maxSeconds'], seconds)
+
+    def event(self, name, values):
+        with self._lock:
+            self.events.append(dict(_plain(values), event=name, time=time.perf_counter()-self._start))
+
+    def report(self):
+        """returns everything recorded as a dict of plain values (JSON ready)"""
+        with self._lock:
+            calls = {}
+            for name, entry in self.calls.items():
+                calls[name] = dict(entry, meanSeconds=entry['seconds']/entry['count'])
+            return _plain({'seconds': self.seconds, 'stages': dict((k, dict(v)) for k, v in self.stages.items()),
+                           'counters': dict(self.counters), 'calls': calls, 'events': list(self.events)})
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Incremental processing for use during a beamtime.
+New h5 runs are folded into the running aligned sum as they land and the global fit is restarted
+from the previous result instead of reprocessing every file and fitting from the initial guesses.
+"""
+import os
+
+import Model_TRXAS_Data as md
+import Model_TRXAS_Fit as mf
+
+ampParams = ['ampS01', 'ampS12', 'ampS23', 'amp2S30', 'amp1S30']
+
+class OnlineSession(object):
+    """
+    Keeps the running aligned sum of the runs added so far, the conditioned kinetics and the last fit
+    s3Model: model for the S3-S0 transition
+    paramD: parameters for fitting, used for the first fit (later fits start from the previous one)
+    lazy, dtype, workers: passed to loadAligned when reading new files
+    conditionArgs: keyword arguments for conditionData (timeBin, kineticTime, finalBkg, ...)
+    """
+    def __init__(self, s3Model, paramD, lazy=True, dtype=None, workers=1, **conditionArgs):
+        self.s3Model = s3Model
+        self.paramD = paramD
+        self.loadArgs = dict(lazy=lazy, dtype=dtype, workers=workers)
+        self.conditionArgs = conditionArgs
+        self.accumulator = md.AlignedSum()
+        self.files = []
+        self.data = None
+        self.fit = None
+        self._fitTraces = 0
+
+    def addFiles(self, filesIn, refit=True):
+        """Folds files not seen before into the running sum and updates the conditioned data (and the fit)
+        filesIn: file paths, ones already added are skipped
+        refit: refit after updating the data
+        returns the latest fit (None if no fit was made yet)"""
+        newFiles = [fileIn for fileIn in filesIn if os.path.abspath(fileIn) not in self.files]
+        if not newFiles:
+            return self.fit
+        md.loadAligned(newFiles, accumulator=self.accumulator, **self.loadArgs)
+        self.files.extend(os.path.abspath(fileIn) for fileIn in newFiles)
+        inputData, _, flashTimes = self.accumulator.result()
+        self.data = md.conditionData(inputData, flashTimes, **self.conditionArgs)
+        if refit:
+            self.refit()
+        return self.fit
+
+    def refit(self):
+        """Fits the current data starting from the previous fit
+        The data are sums over runs so the previous amplitudes are scaled by the change in the number of runs"""
+        xList, kineticList, weights, _ = self.data
+        params = None
+        if self.fit is not None:
+            params = self.fit.params.copy()
+            scale = self.accumulator.numTraces/float(self._fitTraces)
+            for name in ampParams:
+                params[name].value *= scale
+        self.fit = mf.fitData(xList, kineticList, weights, self.s3Model, self.paramD, params=params)
+        self._fitTraces = self.accumulator.numTraces
+        return self.fit
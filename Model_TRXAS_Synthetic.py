@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Writes synthetic time resolved x-ray absorption files in the layout loadData reads.
+Each file holds a 'trace' dataset (3 x time) of Mn fluorescence, scatter and the 10 Hz laser channel,
+with the five flash kinetics made by the Model_TRXAS_Fit models from known parameters plus noise.
+Used as fixtures for the benchmarks and to check that the fit recovers the true parameters.
+"""
+import os
+
+import numpy as np
+import h5py
+
+import Model_TRXAS_Fit as mf
+
+#true parameters used when none are given (amplitudes are per file, the summed data scale with the number of files)
+trueParams = {'initS1': .9, 'pAdvance': .85,
+              'tauS01': 60., 'tauS12': 90., 'tauS23': 400., 'tau1S30': 80., 'tau2S30': 1300.,
+              'ampS01': -10., 'ampS12': 20., 'ampS23': 15., 'amp2S30': -40., 'amp1S30': 10.}
+
+def makeTrace(s3Model=mf.sequentialRate, params=None, traceLength=520000, firstFlash=50000, numFlashes=5,
+              clockRate=1000000, laserFrequency=10, jitter=0, noise=20., baseline=1000., scatter=500.,
+              laserHeight=10., laserWidth=0., seed=None):
+    """Makes one synthetic trace
+    s3Model: model for the S3-S0 transition
+    params: true parameters (default trueParams)
+    traceLength: number of points (us)
+    firstFlash: index of the first flash
+    numFlashes: number of laser flashes
+    clockRate, laserFrequency: recording clock and laser repetition rate
+    jitter: largest random shift (us) of each flash, whole us unless laserWidth is given
+    noise: standard deviation of the fluorescence noise per point
+    baseline, scatter: mean fluorescence and scatter levels
+    laserHeight: height of the laser pulse
+    laserWidth: standard deviation (us) of a gaussian laser pulse, 0 puts the pulse on one point
+        When given the flashes (and jitter) fall at fractions of a us so sub-us alignment can be tested
+    seed: random seed
+    returns (trace array 3 x traceLength, flash times)"""
+    params = dict(trueParams if params is None else params)
+    rng = np.random.RandomState(seed)
+    usPerFlash = clockRate//laserFrequency
+    if laserWidth:
+        flashTimes = [firstFlash+i*usPerFlash+rng.uniform(-jitter, jitter) for i in range(numFlashes)]
+    else:
+        flashTimes = [firstFlash+i*usPerFlash+(rng.randint(-jitter, jitter+1) if jitter else 0) for i in range(numFlashes)]
+
+    trace = np.empty((3, traceLength))
+    trace[0] = baseline+rng.normal(0., noise, traceLength)
+    trace[1] = scatter+rng.normal(0., np.sqrt(scatter), traceLength)
+    trace[2] = rng.normal(0., laserHeight*1e-3, traceLength)
+
+    flashModel = mf.get_flashModel(s3Model)
+    advM = mf.getAdvance(params['initS1'], params['pAdvance'], numFlashes)
+    def basis(t):
+        return flashModel(t, params['tauS01'], params['tauS12'], params['tauS23'], params['tau1S30'], params['tau2S30'],
+                          params['ampS01'], params['ampS12'], params['ampS23'], params['amp2S30'], params['amp1S30'])
+    if not laserWidth:
+        tAfter = basis(np.arange(traceLength-flashTimes[0]-1, dtype=float))
+        for i, flash in enumerate(flashTimes):
+            trace[2, flash] += laserHeight
+            #the change starts the us after the flash, as getKineticData assumes
+            n = traceLength-flash-1
+            trace[0, flash+1:] += advM[i].dot(tAfter[:, :n])
+        return trace, flashTimes
+
+    pulse = np.arange(-int(np.ceil(6*laserWidth)), int(np.ceil(6*laserWidth))+1)
+    for i, flash in enumerate(flashTimes):
+        idx = int(round(flash))+pulse
+        trace[2, idx] += laserHeight*np.exp(-0.5*((idx-flash)/laserWidth)**2)
+        #as above the change starts a us after the flash, here measured from the fractional flash time
+        first = int(np.ceil(flash))+1
+        trace[0, first:] += advM[i].dot(basis(np.arange(first, traceLength)-1-flash))
+    return trace, flashTimes
+
+def makeFile(fileOut, **traceArgs):
+    """Writes one synthetic h5 file
+    fileOut: output file path
+    traceArgs: passed to makeTrace
+    returns the flash times"""
+    trace, flashTimes = makeTrace(**traceArgs)
+    with h5py.File(fileOut, 'w') as f:
+        f.create_dataset('trace', data=trace, compression='gzip', chunks=(1, min(trace.shape[1], 1 << 16)))
+    return flashTimes
+
+def makeFileSet(outDir, numFiles, seed=0, prefix='synthetic', **traceArgs):
+    """Writes a set of synthetic files with different noise (and jitter if asked for)
+    outDir: directory for the files (created if missing)
+    numFiles: number of files
+    seed: seed of the first file, the others use the following seeds
+    prefix: file name prefix
+    traceArgs: passed to makeTrace
+    returns the list of file paths"""
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    filesOut = []
+    for i in range(numFiles):
+        fileOut = os.path.join(outDir, '{}_{:03d}.h5'.format(prefix, i))
+        makeFile(fileOut, seed=seed+i, **traceArgs)
+        filesOut.append(fileOut)
+    return filesOut
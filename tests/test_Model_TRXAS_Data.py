@@ -0,0 +1,64 @@
+"""
+Checks of the data conditioning in Model_TRXAS_Data on synthetic files.
+"""
+import types
+
+import numpy as np
+import pytest
+
+import Model_TRXAS_Data as md
+import Model_TRXAS_Fit as mf
+import Model_TRXAS_Synthetic as ms
+
+def test_flash_offsets_recover_sub_us_flash_times(tmp_path):
+    trueTimes, coarse, pulses = [], [], []
+    for seed in range(4):
+        fileOut = str(tmp_path/'laser{}.h5'.format(seed))
+        trueTimes.append(ms.makeFile(fileOut, traceLength=460000, laserWidth=2., jitter=8, seed=seed))
+        times, filePulses = md.loadLaser(fileOut)
+        coarse.append(times)
+        pulses.append(filePulses)
+    found = np.array(coarse)+md.flashOffsets(np.array(pulses))
+    error = found-np.array(trueTimes)
+    #the times are measured from the centre of the mean pulse, which is symmetric about the true flash
+    assert np.abs(error).max() < 0.1
+    assert np.abs(error-error.mean()).max() < 0.05
+    #the jitter is several us so the whole us positions alone are far off
+    assert np.abs(np.array(coarse)-np.array(trueTimes)).max() > 0.2
+
+def test_residual_bootstrap_keeps_log_bin_noise(tmp_path):
+    fileOut = str(tmp_path/'synthetic.h5')
+    ms.makeFile(fileOut, seed=0)
+    xList, yList, weights, Std, noise = md.getData([fileOut], binning='log', numBins=200, weightFactor=5,
+                                                   returnNoise=True)
+    #the first bins hold single points, the last ones close to a hundred so the bin noise falls several fold
+    assert np.isclose(noise[0][0], Std, rtol=0.1)
+    assert noise[0][0] > 5*noise[0][-1]
+    rng = np.random.RandomState(1)
+    bestFit = mf.packFlashes(yList)
+    fit = types.SimpleNamespace(userkws={'tList': mf.packFlashes(xList)}, weights=mf.packFlashes(weights),
+                                best_fit=bestFit, data=bestFit+rng.normal(0., 1., len(bestFit))*mf.packFlashes(noise))
+    state = dict(mf._resampleState(fit, 'residuals', noise), method='residuals')
+    replicates = np.array([mf.packFlashes(mf._bootstrapData(state, rng)[1]) for _ in range(400)])
+    spread = np.std(replicates-bestFit, axis=0)/mf.packFlashes(noise)
+    assert np.abs(np.median(spread)-1) < 0.1
+    for flash in mf.flashSlices(fit.userkws['tList']):
+        assert np.abs(np.mean(spread[flash][:20])-1) < 0.15
+        assert np.abs(np.mean(spread[flash][-20:])-1) < 0.15
+    #without the bin noise the narrow early bins would get the residuals of the wide quiet bins and the warning says so
+    with pytest.warns(UserWarning):
+        mf._resampleState(fit, 'residuals', None)
+
+@pytest.mark.parametrize('start', [0., 450000., 5e6])
+def test_background_line_matches_polyfit_for_large_x(start):
+    rng = np.random.RandomState(2)
+    x = np.arange(start, start+460000.)
+    y = 1000.+3e-4*(x-start)+rng.normal(0., 20., len(x))
+    for lo, hi in ((3000, 8000), (450000, 455000), (100, 400)):
+        slope, intercept = md.getLinearBkg(x, y, start+lo, start+hi)
+        inside = (x >= start+lo) & (x <= start+hi)
+        #polyfit about the window start keeps its own precision, then the intercept is moved to x = 0
+        refSlope, refIntercept = np.polyfit(x[inside]-start-lo, y[inside], 1)
+        refIntercept -= refSlope*(start+lo)
+        assert abs(slope-refSlope) < 1e-7*abs(refSlope)
+        assert abs(intercept-refIntercept) < 1e-7*abs(refIntercept)
@@ -0,0 +1,81 @@
+"""
+Checks of the analytic derivatives in Model_TRXAS_Fit against central finite differences.
+"""
+import numpy as np
+import lmfit
+import pytest
+
+import Model_TRXAS_Fit as mf
+
+values = {'initS1': .9, 'pAdvance': .85, 'tauS01': 60., 'tauS12': 90., 'tauS23': 400., 'tau1S30': 80.,
+          'tau2S30': 1300., 'ampS01': -10., 'ampS12': 20., 'ampS23': 15., 'amp2S30': -40., 'amp1S30': 10.}
+
+def packedTimes(numFlashes=5):
+    """Log spaced times after each flash, packed as fitData does"""
+    t = np.concatenate(([0.], np.logspace(-1, np.log10(3000), 80)))
+    return mf.packFlashes([t]*numFlashes)
+
+def centralDifference(fn, params, name, rel=1e-6):
+    """Derivative of fn(params) with respect to params[name] by central differences"""
+    step = rel*max(abs(params[name].value), 1.)
+    up, down = params.copy(), params.copy()
+    up[name].value += step
+    down[name].value -= step
+    return (fn(up)-fn(down))/(2*step)
+
+@pytest.mark.parametrize('equalTaus', [False, True])
+@pytest.mark.parametrize('s3Model', mf.s3Models, ids=mf.modelName)
+def test_jacobian_matches_finite_differences(s3Model, equalTaus):
+    tList = packedTimes()
+    params = lmfit.Parameters()
+    for name in mf.modelParams:
+        params.add(name, value=values[name])
+    if equalTaus:
+        #tau1 == tau2 uses the series expansion in _sequentialTerms
+        params['tau2S30'].value = params['tau1S30'].value
+    model = mf.makeTotalModel(s3Model)
+    rng = np.random.RandomState(0)
+    weights = rng.uniform(.5, 2., len(tList))
+    data = model(tList, **values)+rng.normal(0., 1., len(tList))
+
+    def residual(p):
+        return (data-model(tList, **dict((name, p[name].value) for name in mf.modelParams)))*weights
+    jac = mf.makeTotalJacobian(s3Model)(params, data, weights, tList)
+    varNames = [name for name in params if params[name].vary]
+    assert jac.shape == (len(tList), len(varNames))
+    for col, name in enumerate(varNames):
+        expected = centralDifference(residual, params, name)
+        scale = max(np.abs(expected).max(), 1e-8)
+        assert np.abs(jac[:, col]-expected).max() <= 1e-5*scale, name
+
+@pytest.mark.parametrize('initS1, pAdvance', [(.9, .85), (.5, .3), (.99, .99), (.05, .05)])
+def test_advance_gradient_matches_finite_differences(initS1, pAdvance):
+    advM, dAdvInit, dAdvP = mf.getAdvanceGrad(initS1, pAdvance)
+    assert np.allclose(advM, mf.getAdvance(initS1, pAdvance))
+    step = 1e-6
+    fdInit = (mf.getAdvance(initS1+step, pAdvance)-mf.getAdvance(initS1-step, pAdvance))/(2*step)
+    fdP = (mf.getAdvance(initS1, pAdvance+step)-mf.getAdvance(initS1, pAdvance-step))/(2*step)
+    assert np.allclose(dAdvInit, fdInit, rtol=1e-6, atol=1e-8)
+    assert np.allclose(dAdvP, fdP, rtol=1e-6, atol=1e-8)
+
+def test_advance_gradient_broadcasts():
+    initS1, pAdvance = np.array([.5, .9])[:,None], np.array([.3, .85, .99])[None,:]
+    #derivatives that do not depend on a parameter keep its axis as length 1
+    advM, dAdvInit, dAdvP = np.broadcast_arrays(*mf.getAdvanceGrad(initS1, pAdvance))
+    for i in range(2):
+        for j in range(3):
+            single = mf.getAdvanceGrad(initS1[i,0], pAdvance[0,j])
+            for grid, one in zip((advM, dAdvInit, dAdvP), single):
+                assert np.allclose(grid[i,j], one)
+
+@pytest.mark.parametrize('size, first, numChains', [(41, 20, 8), (41, 0, 8), (41, 40, 3), (10, 3, 1), (3, 1, 8), (1, 0, 4)])
+def test_profile_chains_cover_the_grid_walking_outwards(size, first, numChains):
+    chains = mf._profileChains(size, first, numChains)
+    assert sorted(sum(chains, [])) == list(range(size))
+    assert len(chains) == min(size, max(numChains, 1 + (0 < first < size-1)))
+    for chain in chains:
+        steps = np.diff(chain)
+        #each chain is a run of neighbours moving away from first
+        assert np.all(steps == (1 if chain[0] > first else -1))
+        assert abs(chain[0]-first) <= abs(chain[-1]-first)
+    assert first in [chain[0] for chain in chains]